@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""Benchmarks for the symbolic_equation package.
+
+Run e.g. ``python scripts/benchmark.py cache`` from the root of the
+repository. Run without arguments to see all available benchmarks.
+"""
+import os
+import pickle
+import sys
+import threading
+import time
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import sympy
+
+from symbolic_equation import (
+    Eq,
+    LRUCache,
+    deduplicate,
+    dumps_equations,
+    linear_system,
+    loads_equations,
+    render_all,
+)
+
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register `func` as a benchmark"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    """Best wall time (in seconds) of `repeat` calls ``func(*args, **kwargs)``
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def run_threads(n_threads, target, *args):
+    """Run `target(*args)` in `n_threads` threads and wait for them"""
+    threads = [
+        threading.Thread(target=target, args=args) for _ in range(n_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _derivation(n_steps):
+    """Equation with a history of `n_steps` steps"""
+    x, y = sympy.symbols('x y')
+    eq = Eq((x + y) ** 2, sympy.sin(x) * sympy.exp(y))
+    for i in range(n_steps):
+        eq = eq.apply(lambda v: v + i * x)
+    return eq
+
+
+@benchmark
+def cache():
+    """Throughput of rendering and of LRUCache lookups with multiple
+    threads"""
+    eq = _derivation(20)
+    n_renders = 5
+    for render_cache in [None, LRUCache(maxsize=4096)]:
+        Eq.render_cache = render_cache
+        for n_threads in [1, 4]:
+            dt = timed(
+                run_threads,
+                n_threads,
+                lambda: [str(eq) for _ in range(n_renders)],
+            )
+            print(
+                "render_cache=%-5s threads=%d: %8.1f renders/s"
+                % (
+                    render_cache is not None,
+                    n_threads,
+                    n_threads * n_renders / dt,
+                )
+            )
+    Eq.render_cache = None
+    n_lookups = 10000
+    for stripes in [1, 16]:
+        lru = LRUCache(maxsize=1024, stripes=stripes)
+
+        def lookups():
+            for i in range(n_lookups):
+                lru.cached(i % 2048, abs, i)
+
+        for n_threads in [1, 4]:
+            dt = timed(run_threads, n_threads, lookups)
+            print(
+                "LRUCache stripes=%-2d threads=%d: %10.0f lookups/s"
+                % (stripes, n_threads, n_threads * n_lookups / dt)
+            )
+
+
+@benchmark
+def pickling():
+    """Payload size and round-trip time for pickling a batch of equations
+    with shared ancestry"""
+    eqs = []
+    for i in range(50):
+        # equal, but not identical expressions for every equation
+        sympy.core.cache.clear_cache()
+        eqs.append(_derivation(20).apply_to_rhs(lambda v: v + i).tag(i))
+    for (label, dumps, loads) in [
+        ("pickle.dumps", pickle.dumps, pickle.loads),
+        ("dumps_equations", dumps_equations, loads_equations),
+    ]:
+        payload = dumps(eqs)
+        dt = timed(lambda: loads(dumps(eqs)))
+        print(
+            "%-16s %9d bytes, round trip %7.1f ms"
+            % (label, len(payload), 1000 * dt)
+        )
+
+
+@benchmark
+def cse():
+    """Applying simplify to an equation whose sides share a large
+    subexpression, with and without common subexpression elimination"""
+    x, y, a, b = sympy.symbols('x y a b')
+    shared = sum(
+        (sympy.sin(k * x) ** 2 + sympy.cos(k * x) ** 2) * sympy.exp(y / k)
+        for k in range(1, 6)
+    )
+    eq = Eq(a * shared + 1, b * shared - 1)
+    for use_cse in [False, True]:
+        sympy.core.cache.clear_cache()
+        dt = timed(lambda: eq.apply(sympy.simplify, cse=use_cse), repeat=1)
+        print("cse=%-5s %8.2f s" % (use_cse, dt))
+
+
+@benchmark
+def render_scaling():
+    """Rendering many equations with render_all for an increasing number of
+    threads (only scales on a free-threaded Python build)"""
+    eqs = [_derivation(5).tag(i) for i in range(200)]
+    gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print("GIL enabled: %s, CPUs: %s" % (gil_enabled, os.cpu_count()))
+    serial = None
+    for max_workers in [1, 2, 4, 8]:
+        dt = timed(render_all, eqs, max_workers=max_workers)
+        if serial is None:
+            serial = dt
+        print(
+            "threads=%d: %8.1f renders/s (speedup %.2f)"
+            % (max_workers, len(eqs) / dt, serial / dt)
+        )
+
+
+@benchmark
+def verify():
+    """Numerical verification of derivations with many steps"""
+    for n_steps in [100, 1000, 2000]:
+        eq = _derivation(n_steps)
+        dt = timed(eq.verify_history, repeat=1)
+        print("steps=%5d: %8.2f s" % (n_steps, dt))
+
+
+@benchmark
+def derive():
+    """Per-call time of copy, tag, and reset, compared to constructing the
+    same equation through Eq.__init__"""
+    eq = _derivation(20)
+    n_calls = 100000
+
+    def loop(func, *args):
+        for _ in range(n_calls):
+            func(*args)
+
+    init_args = dict(
+        tag=1,
+        _prev_lhs=eq._prev_lhs,
+        _prev_rhs=eq._prev_rhs,
+        _prev_tags=eq._prev_tags,
+    )
+    cases = [
+        ("Eq.__init__", lambda: Eq(eq._lhs, eq._rhs, **init_args)),
+        ("copy", eq.copy),
+        ("tag", lambda: eq.tag(1)),
+        ("reset", eq.reset),
+    ]
+    for (name, func) in cases:
+        dt = timed(loop, func)
+        print("%-12s %8.3f us/call" % (name, 1e6 * dt / n_calls))
+
+
+@benchmark
+def dedup():
+    """Deduplication of equations that are equivalent up to swapped sides
+    and constant factors"""
+    x, y = sympy.symbols('x y')
+    for n_eqs in [250, 500, 1000]:
+        eqs = []
+        for i in range(n_eqs):
+            lhs = (x + i % 50) ** 2
+            rhs = y * (i % 50)
+            if i % 2:
+                eqs.append(Eq(lhs, rhs))
+            else:
+                eqs.append(Eq(-3 * rhs, -3 * lhs))
+        dt = timed(deduplicate, eqs, repeat=1)
+        n_unique = len(deduplicate(eqs))
+        print("eqs=%5d: %8.2f s (%d unique)" % (n_eqs, dt, n_unique))
+
+
+@benchmark
+def conversions():
+    """Per-call time of as_dict and _sympy_ for an equation whose lhs is
+    continued from far up in the history, without and with caching"""
+    x, y = sympy.symbols('x y')
+    eq = Eq(x, y)
+    for i in range(500):
+        eq = eq.apply_to_rhs(lambda v: v + i)
+    n_calls = 10000
+    cases = [
+        ('as_dict', '_as_dict', lambda: eq.as_dict),
+        ('_sympy_', '_sympy_eq', eq._sympy_),
+    ]
+    for (name, cache_attr, func) in cases:
+
+        def uncached():
+            for _ in range(n_calls):
+                eq.__dict__.pop(cache_attr, None)
+                func()
+
+        def cached():
+            for _ in range(n_calls):
+                func()
+
+        print(
+            "%-8s uncached: %8.3f us/call, cached: %8.3f us/call"
+            % (
+                name,
+                1e6 * timed(uncached) / n_calls,
+                1e6 * timed(cached) / n_calls,
+            )
+        )
+
+
+@benchmark
+def linear():
+    """Extracting the sparse matrix form of large cyclic linear systems"""
+    for n in [1000, 2000, 4000]:
+        xs = sympy.symbols('x0:%d' % n)
+        eqs = [
+            Eq(2 * xs[i] - xs[(i + 1) % n] + 3 * xs[(i + 7) % n], i)
+            for i in range(n)
+        ]
+        dt = timed(linear_system, eqs, xs, sparse=True, repeat=1)
+        print("n=%5d: %8.2f s" % (n, dt))
+
+
+def main(argv=None):
+    """Main function"""
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'benchmarks',
+        nargs='*',
+        metavar='BENCHMARK',
+        help="Benchmarks to run. One of: %s" % ", ".join(BENCHMARKS),
+    )
+    args = parser.parse_args(argv)
+    if len(args.benchmarks) == 0:
+        parser.print_help()
+        return 0
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark %r" % name)
+    for name in args.benchmarks:
+        print("== %s ==" % name)
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
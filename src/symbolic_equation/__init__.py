@@ -1,11 +1,66 @@
 """Package providing the :class:`Eq` class for symbolic equations."""
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import operator
+import os
+import pickle
+import sys
+import threading
+import time
+import types
+from array import array
+from collections import OrderedDict, defaultdict, namedtuple
+from pathlib import Path
+
 from uniseg.graphemecluster import grapheme_clusters
 
 
 __version__ = '0.3.0+dev'
 
 
-__all__ = ['Eq']
+__all__ = [
+    'Backend',
+    'DiffColumn',
+    'Eq',
+    'EqIndex',
+    'ExpressionTable',
+    'InternedColumn',
+    'LRUCache',
+    'Operation',
+    'RendererRegistry',
+    'SympyBackend',
+    'deduplicate',
+    'dumps_equations',
+    'get_backend',
+    'latex_renderers',
+    'linear_system',
+    'loads_equations',
+    'memory_usage',
+    'register_backend',
+    'render_all',
+    'render_latex',
+    'render_str',
+    'repr_renderers',
+    'str_renderers',
+    'time_limit',
+    'unregister_backend',
+    'write_latex_report',
+]
+
+
+if hasattr(str, 'isascii'):
+    _is_ascii = str.isascii
+else:  # Python 3.6
+
+    def _is_ascii(text):
+        try:
+            text.encode('ascii')
+            return True
+        except UnicodeEncodeError:
+            return False
 
 
 def _grapheme_len(text):
@@ -18,10 +73,28 @@ def _grapheme_len(text):
         >>> _grapheme_len(s)
         1
     """
+    if _is_ascii(text):
+        # In ASCII, only CR-LF is a multi-character grapheme
+        return len(text) - text.count('\r\n')
     return len(list(grapheme_clusters(text)))
 
 
-def _ljust(text, width, fillchar=' '):
+def _grapheme_lens(texts):
+    """Number of graphemes for each string in `texts`
+
+    This is equivalent to ``[_grapheme_len(text) for text in texts]``, but
+    checks all strings at once, and only segments non-ASCII strings into
+    graphemes::
+
+        >>> _grapheme_lens(['ab', 'Â', ''])
+        [2, 1, 0]
+    """
+    if _is_ascii("".join(texts)):
+        return [len(text) - text.count('\r\n') for text in texts]
+    return [_grapheme_len(text) for text in texts]
+
+
+def _ljust(text, width, fillchar=' ', len_text=None):
     """Left-justify text to a total of `width`
 
     The `width` is based on graphemes::
@@ -31,12 +104,16 @@ def _ljust(text, width, fillchar=' '):
         'Â'
         >>> _ljust(s, 2)
         'Â '
+
+    If the number of graphemes `len_text` in `text` is already known, it can
+    be passed to avoid counting again.
     """
-    len_text = _grapheme_len(text)
+    if len_text is None:
+        len_text = _grapheme_len(text)
     return text + fillchar * (width - len_text)
 
 
-def _rjust(text, width, fillchar=' '):
+def _rjust(text, width, fillchar=' ', len_text=None):
     """Right-justify text for a total of `width` graphemes
 
     The `width` is based on graphemes::
@@ -46,11 +123,896 @@ def _rjust(text, width, fillchar=' '):
         'Â'
         >>> _rjust(s, 2)
         ' Â'
+
+    If the number of graphemes `len_text` in `text` is already known, it can
+    be passed to avoid counting again.
     """
-    len_text = _grapheme_len(text)
+    if len_text is None:
+        len_text = _grapheme_len(text)
     return fillchar * (width - len_text) + text
 
 
+def _last_lhs(prev_lhs):
+    """The last entry in `prev_lhs` that is not None (or None)"""
+    for i in range(len(prev_lhs) - 1, -1, -1):
+        lhs = prev_lhs[i]
+        if lhs is not None:
+            return lhs
+    return None
+
+
+def _sum(terms):
+    """Sum of all `terms`
+
+    If all `terms` are sympy objects, they are combined into a single
+    (flattened) :class:`sympy.Add` instead of building up the sum pairwise.
+    """
+    sympy = sys.modules.get('sympy')
+    if sympy is not None and all(isinstance(t, sympy.Basic) for t in terms):
+        return sympy.Add(*terms)
+    return functools.reduce(operator.add, terms)
+
+
+class RendererRegistry:
+    """Registry of renderers for specific types of expressions.
+
+    Calling the registry with an expression renders that expression with the
+    renderer registered for the expression's type (or the closest base class).
+    The renderer for each type is resolved only once and then cached.
+
+    Args:
+        default: callable that receives a type for which no renderer was
+            registered and returns the renderer to use for that type.
+
+    Example:
+
+        >>> registry = RendererRegistry(default=lambda type_: str)
+        >>> registry.register(float, lambda v: '%.2f' % v)
+        >>> registry(1.0), registry(1)
+        ('1.00', '1')
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._registry = {}
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def register(self, type_, renderer):
+        """Register `renderer` for expressions of type `type_`.
+
+        The `renderer` also applies to subclasses of `type_`, unless a more
+        specific renderer is registered.
+        """
+        with self._lock:
+            self._registry[type_] = renderer
+            self._cache.clear()
+
+    def unregister(self, type_):
+        """Remove the renderer registered for `type_`."""
+        with self._lock:
+            del self._registry[type_]
+            self._cache.clear()
+
+    def clear_cache(self):
+        """Forget the resolved renderer for each type."""
+        with self._lock:
+            self._cache.clear()
+
+    def dispatch(self, type_):
+        """Return the renderer for expressions of type `type_`."""
+        renderer = self._cache.get(type_)
+        if renderer is None:
+            # Resolve under the lock, so that a concurrent `register` cannot
+            # clear the cache between resolving and storing a stale renderer
+            with self._lock:
+                renderer = self._cache.get(type_)
+                if renderer is None:
+                    for cls in type_.__mro__:
+                        renderer = self._registry.get(cls)
+                        if renderer is not None:
+                            break
+                    else:
+                        renderer = self._default(type_)
+                    self._cache[type_] = renderer
+        return renderer
+
+    def __call__(self, expr, *args, **kwargs):
+        return self.dispatch(type(expr))(expr, *args, **kwargs)
+
+
+class Backend:
+    """Support for a specific type of expressions.
+
+    A backend determines the zero element that is used as the default
+    :attr:`~Eq.rhs` of an :class:`Eq`, the default LaTeX renderer, and how
+    expressions are converted to sympy. This base class handles arbitrary
+    expressions, e.g. plain numbers: it uses ``0`` as the zero element, and
+    sympy for LaTeX rendering and conversion, if sympy is installed. It is
+    the fallback for all expressions not handled by any backend registered
+    with :func:`register_backend`.
+
+    Subclasses should override :meth:`handles`, and any of the other methods
+    as appropriate.
+    """
+
+    def handles(self, type_):
+        """Whether the backend is responsible for expressions of `type_`."""
+        return True
+
+    def zero(self, expr):
+        """The zero element for the equation whose lhs is `expr`."""
+        return 0
+
+    def latex(self, expr):
+        """LaTeX representation of `expr`."""
+        try:
+            import sympy
+        except ImportError:
+            raise ValueError("No latex_renderer available")
+        return sympy.latex(expr)
+
+    def to_sympy(self, expr):
+        """Convert `expr` to a sympy object."""
+        import sympy
+
+        return sympy.sympify(expr)
+
+
+class SympyBackend(Backend):
+    """Backend for sympy expressions.
+
+    This backend never imports sympy: it only handles sympy objects, and if
+    such objects exist, sympy has already been imported.
+    """
+
+    def handles(self, type_):
+        sympy = sys.modules.get('sympy')
+        return sympy is not None and issubclass(type_, sympy.Basic)
+
+    def zero(self, expr):
+        return sys.modules['sympy'].S.Zero
+
+    def latex(self, expr):
+        return sys.modules['sympy'].latex(expr)
+
+    def to_sympy(self, expr):
+        return expr
+
+
+_default_backend = Backend()
+_backends = [SympyBackend()]
+_backend_cache = {}
+_backend_lock = threading.Lock()
+
+
+def register_backend(backend):
+    """Register a :class:`Backend` instance.
+
+    Backends that are registered later take precedence over earlier backends.
+    """
+    with _backend_lock:
+        _backends.insert(0, backend)
+        _backend_cache.clear()
+    # outside of `_backend_lock`: resolving a LaTeX renderer holds the lock of
+    # `latex_renderers` while calling `get_backend`
+    latex_renderers.clear_cache()
+
+
+def unregister_backend(backend):
+    """Remove a :class:`Backend` instance registered with
+    :func:`register_backend`.
+
+    Raises:
+        ValueError: if `backend` is not registered
+    """
+    with _backend_lock:
+        _backends.remove(backend)
+        _backend_cache.clear()
+    latex_renderers.clear_cache()
+
+
+def get_backend(type_):
+    """The :class:`Backend` instance for expressions of type `type_`."""
+    backend = _backend_cache.get(type_)
+    if backend is None:
+        with _backend_lock:
+            backend = _backend_cache.get(type_)
+            if backend is None:
+                for candidate in _backends:
+                    if candidate.handles(type_):
+                        backend = candidate
+                        break
+                else:
+                    backend = _default_backend
+                _backend_cache[type_] = backend
+    return backend
+
+
+def _default_latex_renderer(type_):
+    """Default LaTeX renderer for expressions of type `type_`
+
+    This uses the ``_latex`` method of the expression if it exists, and the
+    :meth:`Backend.latex` method of the appropriate backend otherwise.
+    """
+    if hasattr(type_, '_latex'):
+        return operator.methodcaller('_latex')
+    return get_backend(type_).latex
+
+
+#: Registry of renderers used by :meth:`Eq._repr_latex_`
+latex_renderers = RendererRegistry(default=_default_latex_renderer)
+
+#: Registry of renderers used by :meth:`Eq.__str__`
+str_renderers = RendererRegistry(default=lambda type_: str)
+
+#: Registry of renderers used by :meth:`Eq.__repr__`
+repr_renderers = RendererRegistry(default=lambda type_: repr)
+
+
+CacheStats = namedtuple(
+    'CacheStats', ['hits', 'misses', 'evictions', 'currsize', 'maxsize']
+)
+
+
+class LRUCache:
+    """Thread-safe cache with least-recently-used eviction.
+
+    The cache is split into `stripes` independent segments, each protected by
+    its own lock, so that concurrent threads rarely contend for the same lock.
+
+    Args:
+        maxsize (int): maximum number of entries in the cache. The entries are
+            distributed evenly over the stripes.
+        ttl (float or None): If not None, time (in seconds) after which an
+            entry expires
+        stripes (int): number of independently locked segments
+
+    Unhashable keys are never cached: :meth:`cached` will always call the
+    function for them.
+
+    Example:
+
+        >>> cache = LRUCache(maxsize=128)
+        >>> cache.cached('key', str.upper, 'value')
+        'VALUE'
+        >>> cache.cached('key', str.upper, 'value')
+        'VALUE'
+        >>> cache.stats().hits
+        1
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, stripes=16):
+        if maxsize < 1:
+            raise ValueError("Invalid maxsize=%r, must be >= 1" % maxsize)
+        stripes = max(1, min(stripes, maxsize))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._stripe_maxsize = -(-maxsize // stripes)  # ceil division
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._data = [OrderedDict() for _ in range(stripes)]
+        self._counters = [[0, 0, 0] for _ in range(stripes)]
+
+    def _stripe(self, key):
+        return hash(key) % len(self._data)
+
+    def cached(self, key, func, *args, **kwargs):
+        """Return the value for `key`, or store ``func(*args, **kwargs)``."""
+        try:
+            i = self._stripe(key)
+        except TypeError:  # unhashable
+            return func(*args, **kwargs)
+        data = self._data[i]
+        counters = self._counters[i]
+        with self._locks[i]:
+            entry = data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    data.move_to_end(key)
+                    counters[0] += 1
+                    return value
+                del data[key]
+            counters[1] += 1
+        value = func(*args, **kwargs)
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._locks[i]:
+            data[key] = (value, expires)
+            data.move_to_end(key)
+            while len(data) > self._stripe_maxsize:
+                data.popitem(last=False)
+                counters[2] += 1
+        return value
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        for (lock, data, counters) in zip(
+            self._locks, self._data, self._counters
+        ):
+            with lock:
+                data.clear()
+                counters[:] = [0, 0, 0]
+
+    def stats(self):
+        """Return the cache statistics as a :class:`CacheStats` tuple."""
+        hits = misses = evictions = currsize = 0
+        for (lock, data, counters) in zip(
+            self._locks, self._data, self._counters
+        ):
+            with lock:
+                hits += counters[0]
+                misses += counters[1]
+                evictions += counters[2]
+                currsize += len(data)
+        return CacheStats(hits, misses, evictions, currsize, self.maxsize)
+
+    def __len__(self):
+        return sum(len(data) for data in self._data)
+
+
+def _call(func_or_mtd, expr, args, kwargs):
+    """Evaluate a function or the name of a method `func_or_mtd` on `expr`"""
+    if isinstance(func_or_mtd, str):
+        return getattr(expr, func_or_mtd)(*args, **kwargs)
+    else:
+        return func_or_mtd(expr, *args, **kwargs)
+
+
+def _typed_key(value):
+    """Cache key for `value` that distinguishes equal values of different
+    types, also inside of tuples"""
+    if type(value) is tuple:
+        return (tuple, tuple(_typed_key(item) for item in value))
+    return (type(value), value)
+
+
+def _pipeline_step(step):
+    """Normalize a step in :meth:`Eq.apply_pipeline` to a tuple
+    ``(func_or_mtd, args, kwargs)``"""
+    if isinstance(step, tuple):
+        if not 1 <= len(step) <= 3:
+            raise ValueError("Invalid pipeline step: %r" % (step,))
+        func_or_mtd = step[0]
+        args = tuple(step[1]) if len(step) > 1 else ()
+        kwargs = dict(step[2]) if len(step) > 2 else {}
+        return (func_or_mtd, args, kwargs)
+    return (step, (), {})
+
+
+def _time_limit_worker(conn, target, target_args):
+    """Evaluate ``target(*target_args)`` and send the result through `conn`"""
+    try:
+        result = target(*target_args)
+        conn.send((True, result))
+    except BaseException as exc_info:  # pylint: disable=broad-except
+        try:
+            conn.send((False, exc_info))
+        except Exception:  # e.g. the exception is not picklable
+            conn.send((False, RuntimeError(repr(exc_info))))
+    finally:
+        conn.close()
+
+
+def _call_all(func_or_mtd, exprs, args, kwargs):
+    """Evaluate `func_or_mtd` on each of the `exprs`"""
+    return tuple(_call(func_or_mtd, expr, args, kwargs) for expr in exprs)
+
+
+def _call_cse(func_or_mtd, lhs, rhs, args, kwargs):
+    """Evaluate `func_or_mtd` on `lhs` and `rhs` as in ``Eq.apply(...,
+    cse=True)``"""
+    return Eq(lhs, rhs)._apply_cse(func_or_mtd, args, kwargs)
+
+
+class _TimeLimited:
+    """Callable returned by :func:`time_limit`"""
+
+    def __init__(self, func_or_mtd, seconds, on_timeout):
+        self.func_or_mtd = func_or_mtd
+        self.seconds = seconds
+        self.on_timeout = on_timeout
+
+    def __repr__(self):
+        return "time_limit(%r, %r, on_timeout=%r)" % (
+            self.func_or_mtd,
+            self.seconds,
+            self.on_timeout,
+        )
+
+    def _run(self, target, target_args):
+        """Evaluate ``target(*target_args)`` in a worker process
+
+        Return a tuple ``(finished, result)``, where `finished` is False if
+        the worker was killed after :attr:`seconds`.
+        """
+        ctx = multiprocessing.get_context()
+        receiver, sender = ctx.Pipe(duplex=False)
+        worker = ctx.Process(
+            target=_time_limit_worker,
+            args=(sender, target, target_args),
+            daemon=True,
+        )
+        worker.start()
+        sender.close()
+        try:
+            if receiver.poll(self.seconds):
+                try:
+                    success, result = receiver.recv()
+                except EOFError:
+                    worker.join()
+                    raise RuntimeError(
+                        "Worker process for %r died without a result "
+                        "(exit code %s)" % (self.func_or_mtd, worker.exitcode)
+                    )
+            else:
+                worker.terminate()
+                return (False, None)
+        finally:
+            receiver.close()
+            worker.join()
+        if success:
+            return (True, result)
+        else:
+            raise result
+
+    def _timed_out(self, expr):
+        """Apply the `on_timeout` policy to the input `expr`"""
+        if self.on_timeout == 'raise':
+            raise TimeoutError(
+                "%r did not finish within %s seconds"
+                % (self.func_or_mtd, self.seconds)
+            )
+        elif self.on_timeout == 'keep':
+            return expr
+        else:
+            return self.on_timeout(expr)
+
+    def __call__(self, expr, *args, **kwargs):
+        (finished, result) = self._run(
+            _call, (self.func_or_mtd, expr, args, kwargs)
+        )
+        if finished:
+            return result
+        return self._timed_out(expr)
+
+    def _apply_step(self, lhs, rhs, args, kwargs, cse=False):
+        """Transform both `lhs` and `rhs` in a single worker process, and
+        apply the `on_timeout` policy to both sides"""
+        if cse:
+            target = _call_cse
+            target_args = (self.func_or_mtd, lhs, rhs, args, kwargs)
+        else:
+            target = _call_all
+            target_args = (self.func_or_mtd, (lhs, rhs), args, kwargs)
+        (finished, result) = self._run(target, target_args)
+        if finished:
+            return result
+        return (self._timed_out(lhs), self._timed_out(rhs))
+
+
+def time_limit(func_or_mtd, seconds, on_timeout='raise'):
+    """Wrap `func_or_mtd` so that it runs for at most `seconds`.
+
+    The returned callable can be passed to :meth:`Eq.apply`,
+    :meth:`Eq.apply_to_lhs`, :meth:`Eq.apply_to_rhs`, or :meth:`Eq.transform`
+    in place of `func_or_mtd`. Each step is evaluated in a separate worker
+    process, which is killed if it does not finish in time. For
+    :meth:`Eq.apply`, the time limit applies to transforming both sides
+    together, in a single worker process. The worker is started with the
+    platform's default :mod:`multiprocessing` start method. For
+    portability, `func_or_mtd`, the expression and any additional
+    arguments, and the result must all be picklable (e.g., `func_or_mtd` must
+    be a module-level function, not a lambda). If the worker process dies
+    without returning a result, a :exc:`RuntimeError` is raised.
+
+    The `on_timeout` policy determines what happens when the time limit is
+    exceeded:
+
+    * ``'raise'``: raise a :exc:`TimeoutError`
+    * ``'keep'``: return the input unchanged (e.g., keep the old side of the
+      equation). For :meth:`Eq.apply`, both sides are kept.
+    * a callable: return ``on_timeout(expr)``, e.g. a placeholder expression
+      marking the side as "timed out". For :meth:`Eq.apply`, this is applied
+      to both sides; for :meth:`Eq.transform`, it receives the equation.
+
+    Example:
+
+        >>> from sympy import symbols, simplify
+        >>> x = symbols('x')
+        >>> eq = Eq(x**2 - 1, (x - 1) * (x + 1))
+        >>> eq.apply_to_rhs(time_limit(simplify, 10, on_timeout='keep'))
+        x**2 - 1 = (x - 1)*(x + 1)
+                 = x**2 - 1
+    """
+    if not (on_timeout in ('raise', 'keep') or callable(on_timeout)):
+        raise ValueError("Invalid on_timeout=%r" % (on_timeout,))
+    return _TimeLimited(func_or_mtd, seconds, on_timeout)
+
+
+class ExpressionTable:
+    """Interning table that maps expressions to integer IDs.
+
+    Equal expressions of the same type are stored only once and receive the
+    same ID. The ID of None is :attr:`NONE_ID`.
+
+    Example:
+
+        >>> from sympy import symbols
+        >>> x = symbols('x')
+        >>> table = ExpressionTable()
+        >>> table.intern(x + 1), table.intern(x + 1), table.intern(None)
+        (0, 0, -1)
+        >>> table[0]
+        x + 1
+    """
+
+    NONE_ID = -1
+
+    def __init__(self):
+        self._ids = {}
+        self._exprs = []
+        self._lock = threading.Lock()
+
+    def intern(self, expr):
+        """Return the ID of `expr`, adding it to the table if necessary."""
+        if expr is None:
+            return self.NONE_ID
+        try:
+            key = (type(expr), expr)
+            expr_id = self._ids.get(key)
+        except TypeError:  # unhashable: intern by identity
+            key = ('id', id(expr))
+            expr_id = self._ids.get(key)
+        if expr_id is None:
+            with self._lock:
+                expr_id = self._ids.get(key)
+                if expr_id is None:
+                    expr_id = len(self._exprs)
+                    self._exprs.append(expr)
+                    self._ids[key] = expr_id
+        return expr_id
+
+    def __getitem__(self, expr_id):
+        if expr_id == self.NONE_ID:
+            return None
+        return self._exprs[expr_id]
+
+    def __len__(self):
+        return len(self._exprs)
+
+
+#: Table used by :class:`InternedColumn` if no explicit table is given
+default_expression_table = ExpressionTable()
+
+
+class InternedColumn:
+    """Column of the history of an :class:`Eq`, stored as expression IDs.
+
+    This is a drop-in replacement for the lists in which :class:`Eq` stores
+    the history of its left-hand-side, right-hand-side, and tags. Instead of
+    references to the expressions, it stores only the IDs of the expressions
+    in an :class:`ExpressionTable`, in a compact :class:`array.array`.
+
+    Args:
+        items: iterable of initial expressions (or None)
+        table (ExpressionTable or None): the table in which to intern the
+            expressions. If None, use :data:`default_expression_table`.
+    """
+
+    def __init__(self, items=(), table=None, _ids=None):
+        if table is None:
+            table = default_expression_table
+        self.table = table
+        if _ids is None:
+            _ids = array('l', [table.intern(expr) for expr in items])
+        self.ids = _ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return InternedColumn(table=self.table, _ids=self.ids[index])
+        return self.table[self.ids[index]]
+
+    def __iter__(self):
+        table = self.table
+        return (table[expr_id] for expr_id in self.ids)
+
+    def append(self, expr):
+        """Append `expr` to the end of the column."""
+        self.ids.append(self.table.intern(expr))
+
+    def copy(self):
+        """Return a shallow copy of the column."""
+        return InternedColumn(table=self.table, _ids=array('l', self.ids))
+
+    def tobytes(self):
+        """Serialize the expression IDs in the column."""
+        return self.ids.tobytes()
+
+    def __eq__(self, other):
+        if isinstance(other, InternedColumn) and other.table is self.table:
+            return self.ids == other.ids
+        try:
+            return len(self) == len(other) and all(
+                a == b for (a, b) in zip(self, other)
+            )
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return "InternedColumn(%r)" % list(self)
+
+
+def _collect_replacements(old, new, replacements):
+    """Collect the minimal subtrees of `old` that must be replaced by
+    subtrees of `new` into the dict `replacements`"""
+    if old == new:
+        return
+    old_args = old.args
+    new_args = new.args
+    if old.func == new.func and len(old_args) == len(new_args) > 0:
+        for (old_arg, new_arg) in zip(old_args, new_args):
+            _collect_replacements(old_arg, new_arg, replacements)
+    else:
+        replacements[old] = new
+
+
+def _expr_diff(old, new):
+    """Replacement map `diff` such that ``old.xreplace(diff) == new``, or
+    None if `old` and `new` are not sympy expressions with a common
+    structure"""
+    sympy = sys.modules.get('sympy')
+    if sympy is None:
+        return None
+    if not (isinstance(old, sympy.Basic) and isinstance(new, sympy.Basic)):
+        return None
+    replacements = {}
+    _collect_replacements(old, new, replacements)
+    if old in replacements or old.xreplace(replacements) != new:
+        return None
+    return replacements
+
+
+_MISSING = object()
+
+
+class _DiffEntry:
+    """Entry in a :class:`DiffColumn`: either a full expression (`diff` is
+    None), or a replacement map relative to the previous entry"""
+
+    __slots__ = ['expr', 'diff']
+
+    def __init__(self, expr, diff):
+        self.expr = expr
+        self.diff = diff
+
+
+class DiffColumn:
+    """Column of the history of an :class:`Eq`, stored as diffs.
+
+    This is a drop-in replacement for the lists in which :class:`Eq` stores
+    the history of its left-hand-side and right-hand-side. Each sympy
+    expression that shares its structure with the previous entry is stored
+    as a map of replaced subexpressions (as used by ``xreplace``) instead of
+    the full expression. Entries are reconstructed on demand,
+    starting from the closest full "keyframe" entry. The most recent
+    reconstructions are cached, in a cache that is shared between a column
+    and all its copies.
+
+    Args:
+        items: iterable of initial expressions (or None)
+        keyframe_interval (int): maximum number of consecutive diff entries
+            before an entry is stored as a full expression. This bounds the
+            cost of reconstructing an entry.
+        cache_size (int): number of reconstructed entries to cache
+    """
+
+    def __init__(
+        self, items=(), keyframe_interval=32, cache_size=16, _entries=None
+    ):
+        self.keyframe_interval = keyframe_interval
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._n_diffs = 0  # number of diff entries since the last keyframe
+        self._entries = []
+        if _entries is None:
+            for expr in items:
+                self.append(expr)
+        else:
+            self._entries = _entries
+
+    def _new(self, entries, n_diffs):
+        new = DiffColumn(
+            keyframe_interval=self.keyframe_interval,
+            cache_size=self._cache_size,
+            _entries=entries,
+        )
+        new._cache = self._cache
+        new._lock = self._lock
+        new._n_diffs = n_diffs
+        return new
+
+    def _cache_get(self, entry):
+        with self._lock:
+            expr = self._cache.get(entry, _MISSING)
+            if expr is not _MISSING:
+                self._cache.move_to_end(entry)
+            return expr
+
+    def _cache_set(self, entry, expr):
+        with self._lock:
+            self._cache[entry] = expr
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _reconstruct(self, index):
+        entries = self._entries
+        start = index
+        expr = None
+        while True:
+            entry = entries[start]
+            if entry.diff is None:
+                expr = entry.expr
+                break
+            cached = self._cache_get(entry)
+            if cached is not _MISSING:
+                expr = cached
+                break
+            start -= 1
+        for i in range(start + 1, index + 1):
+            expr = expr.xreplace(entries[i].diff)
+        if entries[index].diff is not None:
+            self._cache_set(entries[index], expr)
+        return expr
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self._entries))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            entries = self._entries[start:stop]
+            if len(entries) > 0 and entries[0].diff is not None:
+                entries[0] = _DiffEntry(self._reconstruct(start), None)
+            n_diffs = 0
+            for entry in reversed(entries):
+                if entry.diff is None:
+                    break
+                n_diffs += 1
+            return self._new(entries, n_diffs)
+        if index < 0:
+            index += len(self._entries)
+        if not 0 <= index < len(self._entries):
+            raise IndexError("DiffColumn index out of range")
+        return self._reconstruct(index)
+
+    def __iter__(self):
+        expr = None
+        for entry in self._entries:
+            if entry.diff is None:
+                expr = entry.expr
+            else:
+                expr = expr.xreplace(entry.diff)
+                self._cache_set(entry, expr)
+            yield expr
+
+    def append(self, expr):
+        """Append `expr` to the end of the column."""
+        diff = None
+        if len(self._entries) > 0 and self._n_diffs < self.keyframe_interval:
+            diff = _expr_diff(self[-1], expr)
+        if diff is None:
+            self._entries.append(_DiffEntry(expr, None))
+            self._n_diffs = 0
+        else:
+            entry = _DiffEntry(None, diff)
+            self._entries.append(entry)
+            self._cache_set(entry, expr)
+            self._n_diffs += 1
+
+    def copy(self):
+        """Return a shallow copy of the column."""
+        return self._new(list(self._entries), self._n_diffs)
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(
+                a == b for (a, b) in zip(self, other)
+            )
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return "DiffColumn(%r)" % list(self)
+
+
+Operation = namedtuple(
+    'Operation', ['method', 'args', 'kwargs', 'inputs', 'result']
+)
+Operation.__doc__ = """Operation recorded by :class:`Eq`.
+
+The `method` is the name of the :class:`Eq` method that was called, with
+`args` and `kwargs`. The `inputs` are the lhs and rhs of the equation on which
+the method was called, and `result` is the (unresolved) lhs and rhs of the
+last line of the resulting equation.
+"""
+
+
+def _identical(a, b):
+    """Whether `a` and `b` are of the same type and equal"""
+    if a is b:
+        return True
+    if type(a) is not type(b):
+        return False
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):  # e.g. ambiguous array comparison
+        return False
+
+
+def _normalize_tag(tag):
+    """Convert `tag` to an int, if possible"""
+    try:
+        return int(tag)
+    except (ValueError, TypeError):
+        return tag
+
+
+def _free_symbols(obj):
+    """Set of free symbols of all sympy objects in (nested) `obj`"""
+    if hasattr(obj, 'free_symbols'):
+        return set(obj.free_symbols)
+    if isinstance(obj, dict):
+        obj = itertools.chain(obj.keys(), obj.values())
+    elif not isinstance(obj, (list, tuple, set, frozenset)):
+        return set()
+    symbols = set()
+    for item in obj:
+        symbols.update(_free_symbols(item))
+    return symbols
+
+
+def _random_function(coeffs):
+    """Concrete function of any number of arguments, to stand in for an
+    undefined sympy function in :meth:`Eq.verify_history`"""
+    import sympy
+
+    (a, b, c, d) = [sympy.Float(coeff) for coeff in coeffs]
+    return lambda *args: a * sympy.sin(
+        b + sum(c ** (k + 1) * arg for (k, arg) in enumerate(args))
+    ) + d
+
+
+def _unpickle_eq(cls, state):
+    """Reconstruct an :class:`Eq` pickled by :meth:`Eq.__reduce__`"""
+    (lhs, rhs, tag, prev_rhs, prev_lhs_entries, prev_tag_entries) = state[:6]
+    attrs = state[6]
+    prev_lhs = [None] * len(prev_rhs)
+    for (i, prev) in prev_lhs_entries:
+        prev_lhs[i] = prev
+    prev_tags = [None] * len(prev_rhs)
+    for (i, prev) in prev_tag_entries:
+        prev_tags[i] = prev
+    eq = cls(
+        lhs,
+        rhs,
+        tag,
+        _prev_lhs=prev_lhs,
+        _prev_rhs=prev_rhs,
+        _prev_tags=prev_tags,
+        _ops=(state[7] if len(state) > 7 else None),
+    )
+    eq.__dict__.update(attrs)
+    return eq
+
+
 class Eq:
     """Symbolic equation.
 
@@ -59,7 +1021,8 @@ class Eq:
 
     Args:
         lhs: the left-hand-side of the equation
-        rhs: the right-hand-side of the equation. If None, defaults to zero.
+        rhs: the right-hand-side of the equation. If None, defaults to zero,
+            as determined by the :class:`Backend` for `lhs`.
         tag: a tag (equation number) to be shown when printing
              the equation
         eq_sym_str: If given, a value that overrides the `eq_sym_str` class
@@ -70,16 +1033,41 @@ class Eq:
     Class Attributes:
         latex_renderer: If not None, a callable that must return a LaTeX
             representation (:class:`str`) of `lhs` and `rhs`. When overriding
-            this, wrap the function with `staticmethod`.
+            this, wrap the function with `staticmethod`. If None, use the
+            renderers in the :data:`latex_renderers` registry.
         eq_sym_str: default representation of the "equal" when rendering the
             equation as a str
         eq_sym_tex: default representation of the "equal" when rendering the
             equation in latex
+        align_str: If False, :func:`str` and :func:`repr` do not align the
+            lines of the equation (see :meth:`str_lines`), which is faster
+            for very long equations.
+        display_max_lines: If not None, the maximum number of lines shown
+            by :func:`repr` and in the Jupyter notebook. Longer equations only
+            show the first `display_head` and the last `display_tail` lines.
+            Use :func:`str` or :meth:`to_latex` for the full equation.
+        display_head: number of lines at the beginning of a truncated equation
+        display_tail: number of lines at the end of a truncated equation
+        record_operations: If True, record all operations on the equation
+            (see :attr:`operations` and :meth:`replay`)
+        render_cache: If not None, an :class:`LRUCache` instance in which to
+            cache the text and LaTeX representation of each expression
+        apply_cache: If not None, an :class:`LRUCache` instance in which to
+            cache the result of the functions applied in :meth:`apply`,
+            :meth:`apply_to_lhs`, and :meth:`apply_to_rhs`. Only use this if
+            all applied functions are pure.
     """
 
     latex_renderer = None
     eq_sym_str = "="
     eq_sym_tex = "="
+    align_str = True
+    display_max_lines = None
+    display_head = 10
+    display_tail = 10
+    record_operations = False
+    render_cache = None
+    apply_cache = None
 
     def __init__(
         self,
@@ -91,28 +1079,49 @@ class Eq:
         _prev_lhs=None,
         _prev_rhs=None,
         _prev_tags=None,
+        _ops=None,
     ):
         if rhs is None:
-            try:
-                import sympy
-
-                rhs = sympy.sympify(0)
-            except ImportError:
-                rhs = 0
+            rhs = get_backend(type(lhs)).zero(lhs)
         self._lhs = lhs
-        self._prev_lhs = _prev_lhs or []
-        self._prev_rhs = _prev_rhs or []
-        self._prev_tags = _prev_tags or []
+        self._prev_lhs = [] if _prev_lhs is None else _prev_lhs
+        self._prev_rhs = [] if _prev_rhs is None else _prev_rhs
+        self._prev_tags = [] if _prev_tags is None else _prev_tags
+        self._ops = () if _ops is None else _ops
         self._rhs = rhs
-        try:
-            self._tag = int(tag)
-        except (ValueError, TypeError):
-            self._tag = tag
+        self._tag = _normalize_tag(tag)
         if eq_sym_str is not None:
             self.eq_sym_str = eq_sym_str
         if eq_sym_tex is not None:
             self.eq_sym_tex = eq_sym_tex
 
+    def _derive(
+        self, lhs, rhs, tag, prev_lhs, prev_rhs, prev_tags, share_cache=False
+    ):
+        """New equation of the same class, with the instance attributes of
+        `self` (e.g. :attr:`eq_sym_str` and the recorded operations)
+
+        This is a fast path for the constructor for equations derived from
+        `self`: the arguments are used as-is, without normalization, and the
+        history containers are shared, not copied. If `share_cache` is True,
+        the new equation also shares the cached results of :attr:`as_dict`
+        and :meth:`_sympy_`, which is only valid if its current lhs and rhs
+        are the same as for `self`.
+        """
+        attrs = self.__dict__.copy()
+        if not share_cache:
+            attrs.pop('_as_dict', None)
+            attrs.pop('_sympy_eq', None)
+        attrs['_lhs'] = lhs
+        attrs['_rhs'] = rhs
+        attrs['_tag'] = tag
+        attrs['_prev_lhs'] = prev_lhs
+        attrs['_prev_rhs'] = prev_rhs
+        attrs['_prev_tags'] = prev_tags
+        eq = object.__new__(self.__class__)
+        eq.__dict__ = attrs
+        return eq
+
     @property
     def lhs(self):
         """The left-hand-side of the equation."""
@@ -130,26 +1139,34 @@ class Eq:
 
     def tag(self, tag):
         """Set the tag for the last line in the equation."""
-        return self.__class__(
+        eq = self._derive(
             self._lhs,
             self._rhs,
-            tag=tag,
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
-            _prev_lhs=self._prev_lhs,
-            _prev_rhs=self._prev_rhs,
-            _prev_tags=self._prev_tags,
+            _normalize_tag(tag),
+            self._prev_lhs,
+            self._prev_rhs,
+            self._prev_tags,
+            share_cache=True,
         )
+        return self._record(eq, 'tag', (tag,), {})
 
     @property
     def as_dict(self):
         """Mapping of the lhs to the rhs.
 
         This allows to plug an equation into another expression.
+
+        The mapping is read-only: it is created only once, and shared by
+        copies of the equation (including copies with a different tag). Use
+        ``dict(eq.as_dict)`` to obtain a modifiable dict.
         """
-        return {self.lhs: self.rhs}
+        try:
+            return self._as_dict
+        except AttributeError:
+            self._as_dict = types.MappingProxyType({self.lhs: self.rhs})
+            return self._as_dict
 
-    def apply(self, func_or_mtd, *args, **kwargs):
+    def apply(self, func_or_mtd, *args, amend=False, cse=False, **kwargs):
         """Apply `func_or_mtd` to both sides of the equation.
 
         Returns a new equation where the left-hand-side and right-hand side
@@ -170,68 +1187,276 @@ class Eq:
 
               lhs=func(lhs, *args, **kwargs)
               rhs=func(rhs, *args, **kwargs)
+
+        If `amend` is True, the result replaces the current line of the
+        equation instead of adding a new line. This is equivalent to, but more
+        efficient than chaining :meth:`amend`.
+
+        If `cse` is True, common subexpressions of the lhs and rhs are
+        extracted with :func:`sympy.cse` first. Then, `func_or_mtd` is applied
+        once to each common subexpression and to both reduced sides, before
+        the transformed subexpressions are substituted back in. For expensive
+        functions like :func:`sympy.simplify` this avoids transforming shared
+        parts of the two sides twice. However, `func_or_mtd` then never sees
+        a common subexpression in the context of the full side, which may
+        lead to a different (e.g., less simplified) result.
+
+        The result is only correct if `func_or_mtd` commutes with replacing
+        subexpressions by symbols, i.e., if applying it to an expression
+        gives the same as applying it to the expression with a subexpression
+        replaced by a new symbol, and then substituting the transformed
+        subexpression for that symbol. This holds for simplifications and
+        rewrites (:func:`sympy.simplify`, :func:`sympy.expand`, ...), but not
+        for operations like :func:`sympy.diff`. To support the latter,
+        subexpressions that contain any symbol occurring in `args` or
+        `kwargs` are never extracted, so that e.g. ``apply(diff, x,
+        cse=True)`` remains correct. A function that refers to such a symbol
+        in any other way (e.g., ``lambda expr: expr.diff(x)``) must not be
+        used with ``cse=True``.
+
+        The `amend` and `cse` keyword arguments are not passed to
+        `func_or_mtd`.
         """
-        if isinstance(func_or_mtd, str):
-            new_lhs = getattr(self.lhs, func_or_mtd)(*args, **kwargs)
-            new_rhs = getattr(self.rhs, func_or_mtd)(*args, **kwargs)
+        if isinstance(func_or_mtd, _TimeLimited):
+            # The time limit and the `on_timeout` policy apply to the step as
+            # a whole, so that one side cannot time out while the other
+            # finishes. The `apply_cache` is not used.
+            new_lhs, new_rhs = func_or_mtd._apply_step(
+                self.lhs, self.rhs, args, kwargs, cse=cse
+            )
+        elif cse:
+            new_lhs, new_rhs = self._apply_cse(func_or_mtd, args, kwargs)
         else:
-            new_lhs = func_or_mtd(self.lhs, *args, **kwargs)
-            new_rhs = func_or_mtd(self.rhs, *args, **kwargs)
+            new_lhs = self._apply_func(func_or_mtd, self.lhs, args, kwargs)
+            new_rhs = self._apply_func(func_or_mtd, self.rhs, args, kwargs)
         if new_lhs == self.lhs:
             new_lhs = None
-        return self._append(new_lhs, new_rhs)
+        eq = self._append(new_lhs, new_rhs, amend=amend)
+        if cse:
+            kwargs = dict(kwargs, cse=True)
+        return self._record_step(
+            eq, 'apply', func_or_mtd, args, kwargs, amend
+        )
 
-    def transform(self, func, *args, **kwargs):
+    def apply_pipeline(self, steps, record_all=False, amend=False):
+        """Apply a sequence of functions or methods to both sides.
+
+        Each element of `steps` is either a function or the name of a method
+        (`func_or_mtd` as in :meth:`apply`), or a tuple ``(func_or_mtd,)``,
+        ``(func_or_mtd, args)``, or ``(func_or_mtd, args, kwargs)``. The steps
+        are applied in order, and the result is recorded as a single new line
+        of the equation, which is equivalent to, but more efficient than
+        chaining :meth:`apply` and :meth:`amend`::
+
+            >>> from sympy import symbols
+            >>> x, y = symbols('x y')
+            >>> eq = Eq(2 * x + 4, 2 * y)
+            >>> eq.apply_pipeline([(lambda v, c: v / c, (2,)), 'expand'])
+            2*x + 4 = 2*y
+              x + 2 = y
+
+        If `record_all` is True, each step is recorded as a separate line,
+        exactly as with chained calls to :meth:`apply`. The `amend` argument
+        is as in :meth:`apply`.
+        """
+        steps = [_pipeline_step(step) for step in steps]
+        if record_all:
+            eq = self
+            for (i, (func_or_mtd, args, kwargs)) in enumerate(steps):
+                eq = eq.apply(
+                    func_or_mtd, *args, amend=(amend and i == 0), **kwargs
+                )
+            return eq  # each `apply` is recorded as a separate operation
+        lhs = self.lhs
+        rhs = self.rhs
+        for (func_or_mtd, args, kwargs) in steps:
+            lhs = self._apply_func(func_or_mtd, lhs, args, kwargs)
+            rhs = self._apply_func(func_or_mtd, rhs, args, kwargs)
+        if lhs == self.lhs:
+            lhs = None
+        eq = self._append(lhs, rhs, amend=amend)
+        return self._record_step(eq, 'apply_pipeline', steps, (), {}, amend)
+
+    def transform(self, func, *args, amend=False, **kwargs):
         """Apply `func` to the entire equation.
 
         The lhs and the rhs of the equation is replaced with the lhs and rhs of
         the equation returned by ``func(self, *args, **kwargs)``.
+
+        The `amend` argument is as in :meth:`apply`.
         """
         new_eq = func(self, *args, **kwargs)
         new_lhs = new_eq.lhs
         new_rhs = new_eq.rhs
         if new_lhs == self.lhs:
             new_lhs = None
-        return self._append(new_lhs, new_rhs)
+        eq = self._append(new_lhs, new_rhs, amend=amend)
+        return self._record_step(eq, 'transform', func, args, kwargs, amend)
 
-    def apply_to_lhs(self, func_or_mtd, *args, **kwargs):
+    def apply_to_lhs(self, func_or_mtd, *args, amend=False, **kwargs):
         """Apply `func_or_mtd` to the :attr:`lhs` of the equation only.
 
         Like :meth:`apply`, but modifying only the left-hand-side.
         """
-        if isinstance(func_or_mtd, str):
-            new_lhs = getattr(self.lhs, func_or_mtd)(*args, **kwargs)
-        else:
-            new_lhs = func_or_mtd(self.lhs, *args, **kwargs)
-        return self._append(new_lhs, self.rhs)
+        new_lhs = self._apply_func(func_or_mtd, self.lhs, args, kwargs)
+        eq = self._append(new_lhs, self.rhs, amend=amend)
+        return self._record_step(
+            eq, 'apply_to_lhs', func_or_mtd, args, kwargs, amend
+        )
 
-    def apply_to_rhs(self, func_or_mtd, *args, **kwargs):
+    def apply_to_rhs(self, func_or_mtd, *args, amend=False, **kwargs):
         """Apply `func_or_mtd` to the :attr:`rhs` of the equation only.
 
         Like :meth:`apply`, but modifying only the right-hand-side.
         """
         new_lhs = None
-        if isinstance(func_or_mtd, str):
-            new_rhs = getattr(self.rhs, func_or_mtd)(*args, **kwargs)
-        else:
-            new_rhs = func_or_mtd(self.rhs, *args, **kwargs)
-        return self._append(new_lhs, new_rhs)
+        new_rhs = self._apply_func(func_or_mtd, self.rhs, args, kwargs)
+        eq = self._append(new_lhs, new_rhs, amend=amend)
+        return self._record_step(
+            eq, 'apply_to_rhs', func_or_mtd, args, kwargs, amend
+        )
+
+    def _apply_func(self, func_or_mtd, expr, args, kwargs):
+        cache = self.apply_cache
+        if cache is None:
+            return _call(func_or_mtd, expr, args, kwargs)
+        # Equal values of different types (e.g. 2 and 2.0) may give different
+        # results, so the arguments are keyed by type and value
+        kwargs_key = tuple(
+            sorted((name, _typed_key(val)) for (name, val) in kwargs.items())
+        )
+        key = (func_or_mtd, type(expr), expr, _typed_key(args), kwargs_key)
+        return cache.cached(key, _call, func_or_mtd, expr, args, kwargs)
 
-    def _append(self, new_lhs, new_rhs):
+    @property
+    def operations(self):
+        """Tuple of recorded :class:`Operation` instances.
+
+        Operations are only recorded if :attr:`record_operations` is True for
+        the equation on which an operation is performed, or if any previous
+        operation was recorded. The recorded operations are included when
+        pickling the equation, which requires all functions passed to the
+        operations to be picklable.
+        """
+        return self._ops
+
+    def _record(self, eq, method, args, kwargs, force=False):
+        """Record the operation `method` that produced `eq` from `self`"""
+        if force or self.record_operations or len(self._ops) > 0:
+            eq._ops = self._ops + (
+                Operation(
+                    method=method,
+                    args=args,
+                    kwargs=kwargs,
+                    inputs=(self.lhs, self.rhs),
+                    result=(eq._lhs, eq._rhs),
+                ),
+            )
+        return eq
+
+    def _record_step(self, eq, method, func, args, kwargs, amend):
+        """Record a step that applied `func` (with `args`, `kwargs`)"""
+        if amend:
+            kwargs = dict(kwargs, amend=True)
+        return self._record(eq, method, (func,) + tuple(args), kwargs)
+
+    def replay(self, base):
+        """Re-run all recorded operations, starting from `base`.
+
+        Return the equation that results from performing the same
+        :attr:`operations` that produced this equation, but starting from the
+        equation `base` (e.g., a changed version of the original equation).
+        Steps whose lhs and rhs are identical to the lhs and rhs of the
+        original step re-use the recorded result instead of calling the
+        applied function again. Thus, only the steps that are affected by
+        the changes in `base` are re-computed.
+
+            >>> from sympy import symbols, expand
+            >>> x, y, a = symbols('x y a')
+            >>> Eq.record_operations = True
+            >>> eq = Eq(y, (x + 1)**2).apply_to_rhs(expand)
+            >>> eq = eq.apply('subs', {x: 2})
+            >>> Eq.record_operations = False
+            >>> eq.replay(Eq(y, (x + a)**2))
+            y = (a + x)**2
+              = a**2 + 2*a*x + x**2
+              = a**2 + 4*a + 4
+        """
+        step_methods = (
+            'apply',
+            'apply_to_lhs',
+            'apply_to_rhs',
+            'apply_pipeline',
+            'transform',
+        )
+        eq = base
+        for op in self._ops:
+            if op.method in step_methods and (
+                _identical(eq.lhs, op.inputs[0])
+                and _identical(eq.rhs, op.inputs[1])
+            ):
+                (new_lhs, new_rhs) = op.result
+                amend = op.kwargs.get('amend', False)
+                new_eq = eq._append(new_lhs, new_rhs, amend=amend)
+            else:
+                new_eq = getattr(eq, op.method)(*op.args, **op.kwargs)
+                new_eq._ops = eq._ops
+            eq = eq._record(new_eq, op.method, op.args, op.kwargs, force=True)
+        return eq
+
+    def _apply_cse(self, func_or_mtd, args, kwargs):
+        """Apply `func_or_mtd` to both sides, transforming common
+        subexpressions only once"""
+        import sympy
+
+        lhs = self.lhs
+        rhs = self.rhs
+        replacements = []
+        if isinstance(lhs, sympy.Basic) and isinstance(rhs, sympy.Basic):
+            # Subexpressions that contain a symbol from the arguments (e.g.
+            # the `x` in ``apply(diff, x)``) must stay visible to the function
+            ignore = _free_symbols((args, kwargs))
+            replacements, (lhs, rhs) = sympy.cse([lhs, rhs], ignore=ignore)
+        if len(replacements) == 0:
+            return (
+                self._apply_func(func_or_mtd, self.lhs, args, kwargs),
+                self._apply_func(func_or_mtd, self.rhs, args, kwargs),
+            )
+        replacements = [
+            (sym, self._apply_func(func_or_mtd, expr, args, kwargs))
+            for (sym, expr) in replacements
+        ]
+        new_lhs = self._apply_func(func_or_mtd, lhs, args, kwargs)
+        new_rhs = self._apply_func(func_or_mtd, rhs, args, kwargs)
+        # Later replacements may refer to the symbols of earlier ones
+        for (sym, expr) in reversed(replacements):
+            new_lhs = new_lhs.xreplace({sym: expr})
+            new_rhs = new_rhs.xreplace({sym: expr})
+        return new_lhs, new_rhs
+
+    def _append(self, new_lhs, new_rhs, amend=False):
+        if amend:
+            # Replace the current line. The history containers can be shared
+            # with `self`, as they are never modified in-place.
+            if new_lhs is None and self._lhs is not None:
+                if _last_lhs(self._prev_lhs) != self._lhs:
+                    new_lhs = self._lhs
+            return self._derive(
+                new_lhs,
+                new_rhs,
+                None,
+                self._prev_lhs,
+                self._prev_rhs,
+                self._prev_tags,
+            )
         new_prev_lhs = self._prev_lhs.copy()
         new_prev_lhs.append(self._lhs)
         new_prev_rhs = self._prev_rhs.copy()
         new_prev_rhs.append(self.rhs)
         new_prev_tags = self._prev_tags.copy()
         new_prev_tags.append(self._tag)
-        return self.__class__(
-            new_lhs,
-            new_rhs,
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
-            _prev_lhs=new_prev_lhs,
-            _prev_rhs=new_prev_rhs,
-            _prev_tags=new_prev_tags,
+        return self._derive(
+            new_lhs, new_rhs, None, new_prev_lhs, new_prev_rhs, new_prev_tags
         )
 
     def amend(self, previous_lines=1):
@@ -241,116 +1466,385 @@ class Eq:
         number of previous lines.
 
         This can be chained to e.g. an :meth:`apply` call to group multiple
-        steps so that they don't show up a separate lines in the output.
+        steps so that they don't show up a separate lines in the output. For
+        ``previous_lines=1``, passing ``amend=True`` to :meth:`apply` (or
+        :meth:`apply_to_lhs`, :meth:`apply_to_rhs`, :meth:`transform`) has the
+        same effect without creating the intermediate equation.
         """
         if previous_lines <= 0:
             raise ValueError(
                 "Invalid previous_lines=%r, must be >= 1" % previous_lines
             )
-        new_prev_lhs = self._prev_lhs.copy()[:-previous_lines]
-        new_prev_rhs = self._prev_rhs.copy()[:-previous_lines]
-        new_prev_tags = self._prev_tags.copy()[:-previous_lines]
-        return self.__class__(
-            self._lhs,
+        new_prev_lhs = self._prev_lhs[:-previous_lines]
+        new_prev_rhs = self._prev_rhs[:-previous_lines]
+        new_prev_tags = self._prev_tags[:-previous_lines]
+        lhs = self._lhs
+        if lhs is None:
+            # The lhs is continued from a line that may have been removed
+            lhs = self.lhs
+            if _last_lhs(new_prev_lhs) == lhs:
+                lhs = None
+        eq = self._derive(
+            lhs,
             self.rhs,
-            tag=self._tag,
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
-            _prev_lhs=new_prev_lhs,
-            _prev_rhs=new_prev_rhs,
-            _prev_tags=new_prev_tags,
+            self._tag,
+            new_prev_lhs,
+            new_prev_rhs,
+            new_prev_tags,
+            share_cache=True,
         )
+        return self._record(eq, 'amend', (previous_lines,), {})
 
     def reset(self):
         """Discard the equation history."""
-        return self.__class__(
-            self.lhs,
-            self.rhs,
-            tag=self._tag,
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
+        eq = self._derive(
+            self.lhs, self.rhs, self._tag, [], [], [], share_cache=True
         )
+        return self._record(eq, 'reset', (), {})
 
     def copy(self):
-        """Return a copy of the equation, including its history."""
-        return self.__class__(
+        """Return a copy of the equation, including its history.
+
+        The copy shares the (immutable) history with the original equation.
+        """
+        return self._derive(
+            self._lhs,
+            self._rhs,
+            self._tag,
+            self._prev_lhs,
+            self._prev_rhs,
+            self._prev_tags,
+            share_cache=True,
+        )
+
+    @classmethod
+    def sum(cls, eqs):
+        """Sum of all equations in `eqs`.
+
+        This is equivalent to ``sum(eqs)``, but builds the result in a single
+        pass instead of creating an intermediate equation for every term.
+
+            >>> from sympy import symbols
+            >>> x, y = symbols('x y')
+            >>> Eq.sum([Eq(x, 1), Eq(y, 2), Eq(x - y, 3)])
+            2*x = 6
+        """
+        return cls.linear_combination(None, eqs)
+
+    @classmethod
+    def linear_combination(cls, coeffs, eqs):
+        """Linear combination of the equations in `eqs` with `coeffs`.
+
+        If `coeffs` is None, all coefficients are taken to be one.
+
+            >>> from sympy import symbols
+            >>> x, y = symbols('x y')
+            >>> Eq.linear_combination([1, -2], [Eq(2*x - y, 1), Eq(x + y, 5)])
+            -3*y = -9
+        """
+        eqs = list(eqs)
+        if len(eqs) == 0:
+            raise ValueError("eqs must not be empty")
+        if coeffs is None:
+            lhs_terms = [eq.lhs for eq in eqs]
+            rhs_terms = [eq.rhs for eq in eqs]
+        else:
+            coeffs = list(coeffs)
+            if len(coeffs) != len(eqs):
+                raise ValueError("coeffs and eqs must have the same length")
+            lhs_terms = [c * eq.lhs for (c, eq) in zip(coeffs, eqs)]
+            rhs_terms = [c * eq.rhs for (c, eq) in zip(coeffs, eqs)]
+        return cls(lhs=_sum(lhs_terms), rhs=_sum(rhs_terms))
+
+    def intern_history(self, table=None):
+        """Return a copy of the equation that stores its history compactly.
+
+        The history of the returned equation (and of all equations derived
+        from it) is stored as :class:`InternedColumn` instances, i.e., as
+        arrays of expression IDs in the given :class:`ExpressionTable` (by
+        default, :data:`default_expression_table`). Expressions that occur
+        repeatedly, within one equation or across equations sharing the same
+        table, are stored only once. Note that expressions in a table are
+        never released; use a per-session table to limit its lifetime.
+        """
+        return self._derive(
+            self._lhs,
+            self._rhs,
+            self._tag,
+            InternedColumn(self._prev_lhs, table=table),
+            InternedColumn(self._prev_rhs, table=table),
+            InternedColumn(self._prev_tags, table=table),
+            share_cache=True,
+        )
+
+    def diff_history(self, keyframe_interval=32, cache_size=16):
+        """Return a copy of the equation that stores its history as diffs.
+
+        The history of the left-hand-side and right-hand-side of the returned
+        equation (and of all equations derived from it) is stored as
+        :class:`DiffColumn` instances: each step that changes only part of a
+        sympy expression is stored as a map of the replaced subexpressions.
+        See :class:`DiffColumn` for the meaning of the arguments.
+        """
+        kwargs = dict(
+            keyframe_interval=keyframe_interval, cache_size=cache_size
+        )
+        return self._derive(
+            self._lhs,
+            self._rhs,
+            self._tag,
+            DiffColumn(self._prev_lhs, **kwargs),
+            DiffColumn(self._prev_rhs, **kwargs),
+            list(self._prev_tags),
+            share_cache=True,
+        )
+
+    def verify_history(
+        self, n_points=16, rtol=1e-8, atol=1e-10, domain=(0.5, 2.0), seed=None
+    ):
+        """Numerically check that each step preserves the equation.
+
+        Evaluate the residual ``lhs - rhs`` of every line of the equation's
+        history at `n_points` random sample points, and compare the residual
+        of each line to the residual of the previous line. A step is flagged
+        if the two residuals are not proportional to each other, up to a
+        constant factor (with relative tolerance `rtol`). A residual whose
+        root-mean-square value is below `atol` counts as zero.
+
+        Args:
+            n_points (int): number of sample points
+            rtol (float): relative tolerance for the comparison of residuals
+            atol (float): absolute tolerance for a residual to be zero
+            domain (tuple): interval from which the value of every free
+                symbol is drawn uniformly, for each sample point
+            seed: seed for :func:`numpy.random.default_rng`
+
+        Returns:
+            list: the indices of the lines that do not follow from the
+            previous line
+
+        Each distinct residual is converted to sympy and lambdified (with
+        numpy) once, and then evaluated for all sample points at the same
+        time.
+
+        Example:
+
+            >>> from sympy import symbols, expand
+            >>> x, y = symbols('x y')
+            >>> eq = (
+            ...     Eq((x + 1)**2, y)
+            ...     .apply_to_lhs(expand)
+            ...     .apply(lambda v: 2 * v)
+            ...     .apply_to_lhs(lambda v: v + 1)
+            ... )
+            >>> eq.verify_history(seed=0)
+            [3]
+
+        This is a fast randomized check, not a proof. Transformations that
+        are valid, but do not preserve the residual up to a constant factor
+        will be flagged, e.g. multiplying both sides with an expression, or
+        substituting values for symbols. Sample points where a residual is
+        not finite are ignored, and a step is not flagged if there are no
+        usable sample points. The sides of the equation must be scalars that
+        can be converted to sympy.
+
+        Undefined functions (:class:`sympy.Function` like ``f(x)``) are
+        replaced by the same random concrete function on all lines, and
+        derivatives of them are evaluated. Residuals that cannot be evaluated
+        numerically (e.g., containing an unevaluated :class:`sympy.Integral`)
+        are treated as having no usable sample points, so the steps to and
+        from such a line are not checked.
+        """
+        import numpy as np
+        import sympy
+        from sympy.core.function import AppliedUndef
+
+        residuals = []
+        lhs = None
+        for i in range(len(self._prev_rhs) + 1):
+            (line_lhs, rhs, _) = self._line(i)
+            if line_lhs is not None:
+                lhs = line_lhs
+            residuals.append(
+                get_backend(type(lhs)).to_sympy(lhs)
+                - get_backend(type(rhs)).to_sympy(rhs)
+            )
+        symbols = sorted(
+            set().union(*(r.free_symbols for r in residuals)), key=str
+        )
+        rng = np.random.default_rng(seed)
+        points = rng.uniform(*domain, size=(len(symbols), n_points))
+        heads = sorted(
+            {f.func for r in residuals for f in r.atoms(AppliedUndef)},
+            key=str,
+        )
+        if len(heads) > 0:
+            concrete = {
+                head: _random_function(rng.uniform(*domain, size=4))
+                for head in heads
+            }
+            residuals = [
+                r.replace(
+                    lambda e: isinstance(e, AppliedUndef),
+                    lambda e: concrete[e.func](*e.args),
+                ).replace(
+                    lambda e: isinstance(e, (sympy.Derivative, sympy.Subs)),
+                    lambda e: e.doit(),
+                )
+                for r in residuals
+            ]
+        funcs = {}  # residual => lambdified function
+        nan = np.full(n_points, np.nan, dtype=complex)
+
+        def evaluate(residual):
+            func = funcs.get(residual)
+            # Both lambdify and the evaluation may fail in many ways for
+            # expressions that have no numerical equivalent (NameError,
+            # PrintMethodNotImplementedError, ...). These are "unverifiable"
+            try:
+                if func is None:
+                    func = sympy.lambdify(symbols, residual, modules='numpy')
+                    funcs[residual] = func
+                with np.errstate(all='ignore'):
+                    values = np.asarray(func(*points), dtype=complex)
+                return np.broadcast_to(values, (n_points,))
+            except Exception:
+                funcs[residual] = lambda *args: nan
+                return nan
+
+        flagged = []
+        prev = evaluate(residuals[0])
+        for (i, residual) in enumerate(residuals[1:], start=1):
+            values = evaluate(residual)
+            mask = np.isfinite(prev) & np.isfinite(values)
+            (a, b) = (prev[mask], values[mask])
+            prev = values
+            if len(a) == 0:
+                continue
+            norm_a = np.linalg.norm(a)
+            norm_b = np.linalg.norm(b)
+            zero_a = norm_a <= atol * np.sqrt(len(a))
+            zero_b = norm_b <= atol * np.sqrt(len(b))
+            if zero_a or zero_b:
+                if zero_a != zero_b:
+                    flagged.append(i)
+                continue
+            factor = np.vdot(a, b) / np.vdot(a, a)  # least-squares fit
+            if np.linalg.norm(b - factor * a) > rtol * norm_b:
+                flagged.append(i)
+        return flagged
+
+    def memory_usage(self):
+        """Estimate the memory used by the equation and its history.
+
+        See :func:`memory_usage`.
+        """
+        return memory_usage([self])
+
+    def __reduce__(self):
+        # The history is stored compactly: only the lines that have an lhs or
+        # a tag store an (index, value) entry for them
+        prev_lhs_entries = [
+            (i, lhs)
+            for (i, lhs) in enumerate(self._prev_lhs)
+            if lhs is not None
+        ]
+        prev_tag_entries = [
+            (i, tag)
+            for (i, tag) in enumerate(self._prev_tags)
+            if tag is not None
+        ]
+        attrs = {
+            key: val
+            for (key, val) in self.__dict__.items()
+            if not key.startswith('_')
+        }
+        state = (
             self._lhs,
             self._rhs,
-            tag=self._tag,
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
-            _prev_lhs=self._prev_lhs,
-            _prev_rhs=self._prev_rhs,
-            _prev_tags=self._prev_tags,
+            self._tag,
+            list(self._prev_rhs),
+            prev_lhs_entries,
+            prev_tag_entries,
+            attrs,
         )
+        if len(self._ops) > 0:
+            # The recorded functions must be picklable
+            state += (self._ops,)
+        return (_unpickle_eq, (self.__class__, state))
+
+    def _new_eq(self, lhs, rhs, keep_eq_sym=True):
+        """New equation (without history) of the same class as `self`
+
+        This is a fast path for the constructor for the result of arithmetic
+        operations. If `keep_eq_sym` is True, the instance
+        :attr:`eq_sym_str`/:attr:`eq_sym_tex` of `self` are carried over.
+        Subclasses that override ``__init__`` are always instantiated
+        through their constructor.
+        """
+        if type(self).__init__ is not Eq.__init__:
+            kwargs = {}
+            if keep_eq_sym:
+                kwargs['eq_sym_str'] = self.__dict__.get('eq_sym_str', None)
+                kwargs['eq_sym_tex'] = self.__dict__.get('eq_sym_tex', None)
+            return self.__class__(lhs=lhs, rhs=rhs, **kwargs)
+        attrs = {
+            '_lhs': lhs,
+            '_rhs': rhs,
+            '_tag': None,
+            '_prev_lhs': [],
+            '_prev_rhs': [],
+            '_prev_tags': [],
+            '_ops': (),
+        }
+        if keep_eq_sym:
+            for key in ('eq_sym_str', 'eq_sym_tex'):
+                if key in self.__dict__:
+                    attrs[key] = self.__dict__[key]
+        eq = object.__new__(self.__class__)
+        eq.__dict__ = attrs
+        return eq
 
     def __add__(self, other):
         """Add another equation, or a constant."""
         try:
-            return self.__class__(
-                lhs=(self.lhs + other.lhs),
-                rhs=(self.rhs + other.rhs),
-            )
             # we ignore instance eq_sym_str/eq_sym_tex because we don't know
             # which equation should take precedence
-        except AttributeError:
-            return self.__class__(
-                lhs=(self.lhs + other),
-                rhs=(self.rhs + other),
-                eq_sym_str=self.__dict__.get('eq_sym_str', None),
-                eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
+            return self._new_eq(
+                self.lhs + other.lhs, self.rhs + other.rhs, keep_eq_sym=False
             )
+        except AttributeError:
+            return self._new_eq(self.lhs + other, self.rhs + other)
 
-    __radd__ = __add__
+    def __radd__(self, other):
+        if type(other) is int and other == 0:
+            # start value of the builtin `sum`
+            return self._new_eq(self.lhs, self.rhs)
+        return self.__add__(other)
 
     def __sub__(self, other):
         try:
-            return self.__class__(
-                lhs=(self.lhs - other.lhs), rhs=(self.rhs - other.rhs)
-            )
             # we ignore instance eq_sym_str/eq_sym_tex because we don't know
             # which equation should take precedence
-        except AttributeError:
-            return self.__class__(
-                lhs=(self.lhs - other),
-                rhs=(self.rhs - other),
-                eq_sym_str=self.__dict__.get('eq_sym_str', None),
-                eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
+            return self._new_eq(
+                self.lhs - other.lhs, self.rhs - other.rhs, keep_eq_sym=False
             )
+        except AttributeError:
+            return self._new_eq(self.lhs - other, self.rhs - other)
 
     def __rsub__(self, other):
         # we don't have to consier the case of `other` being an `Eq`, because
         # that would be handled by `__sub__`.
-        return self.__class__(
-            lhs=(other - self.lhs),
-            rhs=(other - self.rhs),
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
-        )
+        return self._new_eq(other - self.lhs, other - self.rhs)
 
     def __mul__(self, other):
-        return self.__class__(
-            lhs=(self.lhs * other),
-            rhs=(self.rhs * other),
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
-        )
+        return self._new_eq(self.lhs * other, self.rhs * other)
 
     def __rmul__(self, other):
-        return self.__class__(
-            lhs=(other * self.lhs),
-            rhs=(other * self.rhs),
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
-        )
+        return self._new_eq(other * self.lhs, other * self.rhs)
 
     def __truediv__(self, other):
-        return self.__class__(
-            lhs=(self.lhs / other),
-            rhs=(self.rhs / other),
-            eq_sym_str=self.__dict__.get('eq_sym_str', None),
-            eq_sym_tex=self.__dict__.get('eq_sym_tex', None),
-        )
+        return self._new_eq(self.lhs / other, self.rhs / other)
 
     def __eq__(self, other):
         """Compare to another equation, or a constant.
@@ -365,43 +1859,135 @@ class Eq:
         except AttributeError:
             return self.rhs == other
 
-    def _render_str(self, renderer, *args, **kwargs):
+    def _line(self, i):
+        """The (lhs, rhs, tag) of the line with index `i`"""
+        if i < len(self._prev_rhs):
+            return (self._prev_lhs[i], self._prev_rhs[i], self._prev_tags[i])
+        return (self._lhs, self._rhs, self._tag)
+
+    def _iter_lines(self, truncate=False):
+        """Iterate over the (lhs, rhs, tag) of each line
+
+        If `truncate` is True and the equation has more lines than
+        :attr:`display_max_lines`, only yield the first :attr:`display_head`
+        and the last :attr:`display_tail` lines, separated by None.
+        """
+        n_lines = len(self._prev_rhs) + 1
+        max_lines = self.display_max_lines
+        head = self.display_head
+        tail = self.display_tail
+        if truncate and max_lines is not None and n_lines > max_lines:
+            if head + tail < n_lines:
+                for i in range(head):
+                    yield self._line(i)
+                yield None
+                for i in range(n_lines - tail, n_lines):
+                    yield self._line(i)
+                return
+        yield from zip(self._prev_lhs, self._prev_rhs, self._prev_tags)
+        yield (self._lhs, self._rhs, self._tag)
+
+    def _render_cells(self, renderer, *args, truncate=False, **kwargs):
+        """Iterate over the rendered (lhs, rhs, tag) of each line
+
+        Missing lhs and tags are rendered as empty strings. Omitted lines (see
+        :meth:`_iter_lines`) are indicated by None.
+        """
+        if args or kwargs:
+            render = lambda expr: renderer(expr, *args, **kwargs)
+        else:
+            render = functools.partial(self._render_expr, renderer)
+        for line in self._iter_lines(truncate=truncate):
+            if line is None:
+                yield None
+                continue
+            (lhs, rhs, tag) = line
+            yield (
+                '' if lhs is None else render(lhs),
+                render(rhs),
+                '' if tag is None else render(tag),
+            )
+
+    def str_lines(self, widths=None, renderer=None, truncate=False):
+        """Iterate over the lines of the text representation.
+
+        Unlike :func:`str`, the lines are not aligned, unless fixed `widths`
+        are given as a tuple ``(lhs_width, rhs_width)``. In the latter case,
+        the width is counted in code points, not graphemes. Each line is
+        rendered only when it is requested, so this is suitable for streaming
+        the output of very long equations.
+
+        The `renderer` defaults to :data:`str_renderers`. If `truncate` is
+        True, omit lines according to :attr:`display_max_lines`.
+
+            >>> from sympy import symbols
+            >>> x, y = symbols('x y')
+            >>> eq = Eq(2 * x - y, 1, tag='I').apply(lambda v: v + y)
+            >>> for line in eq.str_lines():
+            ...     print(line)
+            2*x - y = 1    (I)
+            2*x = y + 1
+            >>> for line in eq.str_lines(widths=(8, 6)):
+            ...     print(line)
+             2*x - y = 1         (I)
+                 2*x = y + 1
+        """
+        if renderer is None:
+            renderer = str_renderers
+        eq_sym = " " + self.eq_sym_str + " "
+        for cells in self._render_cells(renderer, truncate=truncate):
+            if cells is None:
+                yield "..."
+                continue
+            (lhs, rhs, tag) = cells
+            if widths is not None:
+                lhs = lhs.rjust(widths[0])
+                rhs = rhs.ljust(widths[1])
+            if len(tag) > 0:
+                yield lhs + eq_sym + rhs + "    (" + tag + ")"
+            else:
+                yield (lhs + eq_sym + rhs).rstrip()
+
+    def _render_str(self, renderer, *args, truncate=False, **kwargs):
+        if not self.align_str:
+            return "\n".join(
+                self.str_lines(renderer=renderer, truncate=truncate)
+            )
         rendered_lhs = []
         rendered_rhs = []
         rendered_tags = []
-
-        for i, rhs in enumerate(self._prev_rhs):
-            lhs = self._prev_lhs[i]
-            tag = self._prev_tags[i]
-            if lhs is None:
-                rendered_lhs.append('')
-            else:
-                rendered_lhs.append(renderer(lhs, *args, **kwargs))
-            rendered_rhs.append(renderer(rhs, *args, **kwargs))
-            if tag is None:
-                rendered_tags.append('')
-            else:
-                rendered_tags.append(renderer(tag, *args, **kwargs))
-        if self._lhs is None:
-            rendered_lhs.append('')
-        else:
-            rendered_lhs.append(renderer(self._lhs, *args, **kwargs))
-        rendered_rhs.append(renderer(self._rhs, *args, **kwargs))
-        if self._tag is None:
-            rendered_tags.append('')
-        else:
-            rendered_tags.append(renderer(self._tag, *args, **kwargs))
-        len_lhs = max([_grapheme_len(s) for s in rendered_lhs])
-        len_rhs = max([_grapheme_len(s) for s in rendered_rhs])
-        len_tag = max([_grapheme_len(s) for s in rendered_tags]) + 2
+        elided = None  # index of the line standing in for omitted lines
+        for cells in self._render_cells(
+            renderer, *args, truncate=truncate, **kwargs
+        ):
+            if cells is None:
+                elided = len(rendered_lhs)
+                cells = ('', '', '')
+            rendered_lhs.append(cells[0])
+            rendered_rhs.append(cells[1])
+            rendered_tags.append(cells[2])
+        n = len(rendered_lhs)
+        lens = _grapheme_lens(rendered_lhs + rendered_rhs + rendered_tags)
+        lens_lhs = lens[:n]
+        lens_rhs = lens[n : 2 * n]
+        lens_tags = lens[2 * n :]
+        len_lhs = max(lens_lhs)
+        len_rhs = max(lens_rhs)
+        len_tag = max(lens_tags) + 2
 
         lines = []
-        for (lhs, rhs, tag) in zip(rendered_lhs, rendered_rhs, rendered_tags):
+        for i in range(n):
+            if i == elided:
+                lines.append(" " * len_lhs + " ...")
+                continue
+            tag = rendered_tags[i]
+            len_tag_i = lens_tags[i]
             if len(tag) > 0:
                 tag = "(" + tag + ")"
-            lhs = _rjust(lhs, len_lhs)
-            rhs = _ljust(rhs, len_rhs)
-            tag = _ljust(tag, len_tag)
+                len_tag_i += 2
+            lhs = _rjust(rendered_lhs[i], len_lhs, len_text=lens_lhs[i])
+            rhs = _ljust(rendered_rhs[i], len_rhs, len_text=lens_rhs[i])
+            tag = _ljust(tag, len_tag, len_text=len_tag_i)
             lines.append(
                 (
                     lhs + " " + self.eq_sym_str + " " + rhs + "    " + tag
@@ -410,67 +1996,66 @@ class Eq:
         return "\n".join(lines)
 
     def __str__(self):
-        return self._render_str(renderer=str)
+        return self._render_str(renderer=str_renderers)
 
     def __repr__(self):
-        return self._render_str(renderer=repr)
+        return self._render_str(renderer=repr_renderers, truncate=True)
+
+    def _render_expr(self, renderer, expr):
+        if isinstance(renderer, RendererRegistry):
+            renderer = renderer.dispatch(type(expr))
+        cache = self.render_cache
+        if cache is None:
+            return renderer(expr)
+        return cache.cached((renderer, type(expr), expr), renderer, expr)
 
     def _latex_render_expr(self, expr):
         if self.latex_renderer is not None:
-            return self.latex_renderer(expr)
+            return self._render_expr(self.latex_renderer, expr)
         else:
-            try:
-                return expr._latex()
-            except AttributeError:
-                try:
-                    import sympy
+            return self._render_expr(latex_renderers, expr)
 
-                    return sympy.latex(expr)
-                except ImportError:
-                    raise ValueError("No latex_renderer available")
+    def to_latex(self, truncate=False):
+        """LaTeX representation of the equation.
 
-    def _repr_latex_(self):
-        """LaTeX representation for Jupyter notebook."""
+        Unlike the representation in the Jupyter notebook, this includes the
+        full history of the equation, unless `truncate` is True.
+        """
         has_history = len(self._prev_rhs) > 0
         if has_history:
-            res = r'\begin{align}' + "\n"
-            res += "  %s &= %s" % (
-                self._latex_render_expr(self._prev_lhs[0]),
-                self._latex_render_expr(self._prev_rhs[0]),
-            )
-            if self._prev_tags[0] is not None:
-                res += r'\tag{%s}' % self._prev_tags[0]
-            res += "\\\\\n"
-            for i, rhs in enumerate(self._prev_rhs[1:]):
-                lhs = self._prev_lhs[i + 1]
-                if lhs is None:
-                    res += "   &%s %s" % (
+            rows = []
+            for (i, line) in enumerate(self._iter_lines(truncate=truncate)):
+                if line is None:
+                    rows.append((r'   &\vdots', None))
+                    continue
+                (lhs, rhs, tag) = line
+                if i == 0:
+                    row = "  %s &= %s" % (
+                        self._latex_render_expr(lhs),
+                        self._latex_render_expr(rhs),
+                    )
+                elif lhs is None:
+                    row = "   &%s %s" % (
                         self.eq_sym_tex,
                         self._latex_render_expr(rhs),
                     )
                 else:
-                    res += "  %s &%s %s" % (
+                    row = "  %s &%s %s" % (
                         self._latex_render_expr(lhs),
                         self.eq_sym_tex,
                         self._latex_render_expr(rhs),
                     )
-                if self._prev_tags[i + 1] is not None:
-                    res += r'\tag{%s}' % self._prev_tags[i + 1]
+                rows.append((row, tag))
+            res = r'\begin{align}' + "\n"
+            for (row, tag) in rows[:-1]:
+                res += row
+                if tag is not None:
+                    res += r'\tag{%s}' % tag
                 res += "\\\\\n"
-            lhs = self._lhs
-            if lhs is None:
-                res += "   &%s %s\n" % (
-                    self.eq_sym_tex,
-                    self._latex_render_expr(self.rhs),
-                )
-            else:
-                res += "  %s &%s %s\n" % (
-                    self._latex_render_expr(lhs),
-                    self.eq_sym_tex,
-                    self._latex_render_expr(self.rhs),
-                )
-            if self._tag is not None:
-                res += r'\tag{%s}' % self._tag
+            (row, tag) = rows[-1]
+            res += row + "\n"
+            if tag is not None:
+                res += r'\tag{%s}' % tag
             res += r'\end{align}' + "\n"
         else:
             res = r'\begin{equation}' + "\n"
@@ -479,16 +2064,762 @@ class Eq:
                 self.eq_sym_tex,
                 self._latex_render_expr(self.rhs),
             )
-            try:
-                if self._tag is not None:
-                    res += r'\tag{%s}' % self._tag
-            except AttributeError:
-                pass
+            if self._tag is not None:
+                res += r'\tag{%s}' % self._tag
             res += r'\end{equation}' + "\n"
         return res
 
+    def _repr_latex_(self):
+        """LaTeX representation for Jupyter notebook.
+
+        For long equations, this may omit lines in the middle of the equation,
+        see :attr:`display_max_lines`. Use :meth:`to_latex` for the full
+        representation.
+        """
+        return self.to_latex(truncate=True)
+
+    def canonical_key(self):
+        """Canonical form of the equation, for comparing equations.
+
+        Return the sympy expression obtained by moving everything to one side
+        (``lhs - rhs``), expanding, and dividing by the numerical coefficient
+        of the leading term (the first term when printing the expression).
+        Equations that only differ by swapped sides, by a constant factor, or
+        by an algebraic rearrangement that :func:`sympy.expand` undoes have
+        the same key. The key only depends on the current lhs and rhs, not
+        on the history.
+
+            >>> from sympy import symbols
+            >>> x, y = symbols('x y')
+            >>> Eq(2 * x, 4 * y + 2).canonical_key()
+            x - 2*y - 1
+            >>> Eq(y, (x - 1) / 2).canonical_key()
+            x - 2*y - 1
+
+        Keys from floating point coefficients are subject to rounding, and
+        may therefore differ for equivalent equations.
+        """
+        import sympy
+
+        lhs = self.lhs
+        rhs = self.rhs
+        residual = sympy.expand(
+            get_backend(type(lhs)).to_sympy(lhs)
+            - get_backend(type(rhs)).to_sympy(rhs)
+        )
+        if residual == 0:
+            return residual
+        (coeff, _) = residual.as_ordered_terms()[0].as_coeff_Mul()
+        if coeff == 1:
+            return residual
+        return sympy.expand(residual / coeff)
+
     def _sympy_(self):
-        """Convert to a :class:`sympy.Eq`."""
-        from sympy import Eq as SympyEq
+        """Convert to a :class:`sympy.Eq`.
+
+        The result is cached, and shared by copies of the equation.
+        """
+        try:
+            return self._sympy_eq
+        except AttributeError:
+            from sympy import Eq as SympyEq
+
+            lhs = self.lhs
+            rhs = self.rhs
+            self._sympy_eq = SympyEq(
+                get_backend(type(lhs)).to_sympy(lhs),
+                get_backend(type(rhs)).to_sympy(rhs),
+            )
+            return self._sympy_eq
+
+
+def linear_system(eqs, symbols, sparse=False, dtype=float):
+    """Coefficient matrix and vector for a system of linear equations.
+
+    Args:
+        eqs: iterable of equations (:class:`Eq` instances or any other object
+            with ``lhs`` and ``rhs`` attributes) whose sides are sympy
+            expressions that are linear in `symbols`
+        symbols: list of sympy symbols (the unknowns). The order determines
+            the order of the columns of the coefficient matrix
+        sparse (bool): If True, return the coefficient matrix as a
+            :class:`scipy.sparse.csr_matrix`. Otherwise, return a dense
+            :class:`numpy.ndarray`.
+        dtype: the numpy data type for the coefficients
+
+    Returns:
+        tuple: ``(A, b)`` such that the system of equations is ``A @ x = b``,
+        where ``x`` is the vector of `symbols`. The result can be passed
+        directly to e.g. :func:`numpy.linalg.solve`, or
+        :func:`scipy.sparse.linalg.spsolve` if `sparse` is True.
+
+    Raises:
+        ValueError: if any equation is not linear in `symbols`, or contains
+            terms that cannot be converted to `dtype`.
+
+    Example:
+
+        >>> import numpy as np
+        >>> from sympy import symbols
+        >>> x, y = symbols('x y')
+        >>> A, b = linear_system([Eq(2*x - y, 1), Eq(x + y, 5)], [x, y])
+        >>> A
+        array([[ 2., -1.],
+               [ 1.,  1.]])
+        >>> b
+        array([1., 5.])
+        >>> np.linalg.solve(A, b)
+        array([2., 3.])
+    """
+    import numpy as np
+    import sympy
+
+    symbols = list(symbols)
+    index = {sym: j for (j, sym) in enumerate(symbols)}
+    unknowns = index.keys()
+    n_terms = []
+    cols = []
+    vals = []
+    consts = []
+    for (i, eq) in enumerate(eqs):
+        residual = sympy.expand(sympy.sympify(eq.lhs - eq.rhs))
+        const = 0
+        terms = residual.as_coefficients_dict().items()
+        for (term, coeff) in terms:
+            # Finding the unknown through the free symbols of the term (and
+            # not with `term.as_independent(*symbols)`) avoids scanning all
+            # `symbols` for every term
+            syms = unknowns & term.free_symbols
+            if len(syms) == 0:
+                const += coeff * term
+                continue
+            if len(syms) == 1:
+                (sym,) = syms
+                if term == sym:
+                    cols.append(index[sym])
+                    vals.append(coeff)
+                    continue
+                if term.is_Mul and sym in term.args:
+                    indep = term.func(*[a for a in term.args if a != sym])
+                    if sym not in indep.free_symbols:
+                        cols.append(index[sym])
+                        vals.append(coeff * indep)
+                        continue
+            raise ValueError(
+                "Equation %d is not linear in the given symbols: %s"
+                % (i, term)
+            )
+        n_terms.append(len(cols))
+        consts.append(-const)
+    rows = np.repeat(
+        np.arange(len(consts), dtype=np.intp),
+        np.diff(np.array([0] + n_terms, dtype=np.intp)),
+    )
+    shape = (len(consts), len(symbols))
+    try:
+        vals = np.array(vals, dtype=dtype)
+        b = np.array(consts, dtype=dtype)
+    except TypeError as exc_info:
+        raise ValueError("Cannot convert coefficients: %s" % exc_info)
+    cols = np.array(cols, dtype=np.intp)
+    if sparse:
+        import scipy.sparse
+
+        A = scipy.sparse.coo_matrix((vals, (rows, cols)), shape=shape)
+        return A.tocsr(), b
+    else:
+        A = np.zeros(shape, dtype=dtype)
+        np.add.at(A, (rows, cols), vals)
+        return A, b
+
+
+_REPORT_PREAMBLE = r"""\documentclass{article}
+\usepackage{amsmath}
+"""
+
+
+def _stable_name(obj):
+    """Name of `obj` that is the same in every Python process
+
+    For functions and classes, this is the qualified name; for bound
+    methods, the name of the function and of the object it is bound to; for
+    other objects, the name of their class (not the ``repr``, which may
+    contain a memory address).
+    """
+    if obj is None:
+        return 'None'
+    func = getattr(obj, '__func__', None)
+    if func is not None:  # bound method
+        return _stable_name(func) + ' of ' + _stable_name(obj.__self__)
+    if not hasattr(obj, '__qualname__'):
+        obj = type(obj)
+    return '%s.%s' % (getattr(obj, '__module__', None), obj.__qualname__)
+
+
+def _registry_state(registry):
+    """Description of the renderers registered in `registry`"""
+    return sorted(
+        (_stable_name(type_), _stable_name(renderer))
+        for (type_, renderer) in registry._registry.items()
+    )
+
+
+def _update_digest(digest, expr):
+    """Add the expression `expr` to the hash `digest`"""
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(expr, numpy.ndarray):
+        # the repr of large arrays elides entries
+        header = ('ndarray', expr.dtype.str, expr.shape)
+        digest.update(repr(header).encode('utf-8'))
+        if expr.dtype.hasobject:
+            for item in expr.flat:
+                digest.update(b',')
+                _update_digest(digest, item)
+        else:
+            digest.update(numpy.ascontiguousarray(expr).tobytes())
+    else:
+        digest.update(repr(expr).encode('utf-8'))
+
+
+def _history_digest(eq):
+    """Hash of everything that determines the LaTeX representation of
+    `eq`"""
+    digest = hashlib.sha256()
+    header = (
+        _stable_name(type(eq)),
+        eq.eq_sym_tex,
+        _stable_name(eq.latex_renderer),
+        _registry_state(latex_renderers),
+        [_stable_name(backend) for backend in _backends],
+    )
+    digest.update(repr(header).encode('utf-8'))
+    for line in eq._iter_lines():
+        digest.update(b'\n')
+        for expr in line:
+            digest.update(b'\t')
+            _update_digest(digest, expr)
+    return digest.hexdigest()
+
+
+def write_latex_report(eqs, folder, name='report', preamble=None, prune=True):
+    """Write a LaTeX document containing all the equations in `eqs`.
+
+    The LaTeX code for each equation is written to a separate fragment file in
+    the subfolder ``fragments`` of `folder`. The name of each fragment is the
+    hash of the equation's history, so that the LaTeX code for an equation
+    is generated only if no fragment for that history exists yet. The master
+    document ``<name>.tex`` in `folder` includes all fragments, and is
+    rewritten only if its content changes. Thus, when writing a report
+    repeatedly, only new or changed equations are rendered, and tools like
+    ``latexmk`` only rebuild the PDF if anything changed.
+
+    Args:
+        eqs: iterable of :class:`Eq` instances
+        folder (str or pathlib.Path): folder in which to write the report
+        name (str): name of the master document, without the ``.tex``
+            extension
+        preamble (str or None): LaTeX code preceding ``\begin{document}`` in
+            the master document. Must load the ``amsmath`` package.
+        prune (bool): whether to delete fragments that are not used by the
+            report
+
+    Returns:
+        pathlib.Path: the path to the master document
+    """
+    if preamble is None:
+        preamble = _REPORT_PREAMBLE
+    folder = Path(folder)
+    fragments = folder / 'fragments'
+    fragments.mkdir(parents=True, exist_ok=True)
+    used = set()
+    lines = [preamble.rstrip("\n"), r'\begin{document}']
+    for eq in eqs:
+        key = _history_digest(eq)
+        fragment = fragments / (key + '.tex')
+        if key not in used and not fragment.is_file():
+            tmp = fragment.with_suffix('.tmp')
+            tmp.write_text(eq.to_latex(), encoding='utf-8')
+            tmp.replace(fragment)  # atomic: never leave partial fragments
+        used.add(key)
+        lines.append(r'\input{fragments/%s}' % key)
+    lines.append(r'\end{document}')
+    content = "\n".join(lines) + "\n"
+    master = folder / (name + '.tex')
+    if not (master.is_file() and master.read_text('utf-8') == content):
+        master.write_text(content, encoding='utf-8')
+    if prune:
+        for fragment in fragments.glob('*.tex'):
+            if fragment.stem not in used:
+                fragment.unlink()
+    return master
+
+
+def _shared_eq(eq, exprs):
+    """Copy of `eq` in which all expressions are replaced by the equal
+    expression in the dict `exprs`, if any (otherwise, `exprs` is updated)"""
+
+    def share(expr):
+        if expr is None:
+            return None
+        try:
+            return exprs.setdefault((type(expr), expr), expr)
+        except TypeError:  # unhashable
+            return expr
+
+    return eq._derive(
+        share(eq._lhs),
+        share(eq._rhs),
+        eq._tag,
+        [share(lhs) for lhs in eq._prev_lhs],
+        [share(rhs) for rhs in eq._prev_rhs],
+        list(eq._prev_tags),
+    )
+
+
+def dumps_equations(eqs, protocol=pickle.HIGHEST_PROTOCOL):
+    """Pickle a list of equations into a single payload.
+
+    Equal expressions that occur in several equations (or several times in
+    the history of an equation) are serialized only once. Use
+    :func:`loads_equations` to restore the list of equations.
+    """
+    exprs = {}
+    return pickle.dumps([_shared_eq(eq, exprs) for eq in eqs], protocol)
+
+
+def loads_equations(data):
+    """Restore a list of equations pickled with :func:`dumps_equations`."""
+    return pickle.loads(data)
+
+
+class EqIndex:
+    """Searchable index over a collection of equations.
+
+    The index maintains inverted indexes from the :attr:`~Eq.lhs` of each
+    equation, from the free symbols of both sides, from the top-level
+    operator of each side, and from all function heads (e.g.,
+    :class:`sympy.sin`) occurring in either side, to the IDs of the matching
+    equations. Equations can be added and removed at any time.
+
+    Args:
+        eqs: iterable of initial equations
+
+    Example:
+
+        >>> from sympy import symbols, sin, Add
+        >>> x, y, z = symbols('x y z')
+        >>> index = EqIndex([Eq(x, y + 1), Eq(y, sin(z)), Eq(z, x * y)])
+        >>> index.query(lhs=y)
+        [1]
+        >>> index.query(symbols=[x, y])
+        [0, 2]
+        >>> index.query(heads=[sin]), index.query(ops=[Add])
+        ([1], [0])
+        >>> index.delete(0)
+        >>> index.query(symbols=[x])
+        [2]
+    """
 
-        return SympyEq(self.lhs, self.rhs)
+    def __init__(self, eqs=()):
+        self._eqs = {}
+        self._keys = {}
+        self._next_id = 0
+        self._by_lhs = defaultdict(set)
+        self._by_symbol = defaultdict(set)
+        self._by_op = defaultdict(set)
+        self._by_head = defaultdict(set)
+        for eq in eqs:
+            self.insert(eq)
+
+    @staticmethod
+    def _index_keys(eq):
+        """Keys under which `eq` is stored in each of the indexes"""
+        sides = (eq.lhs, eq.rhs)
+        try:
+            lhs_keys = [(type(sides[0]), sides[0])]
+            hash(lhs_keys[0])
+        except TypeError:  # unhashable lhs
+            lhs_keys = []
+        symbols = set()
+        ops = set()
+        heads = set()
+        sympy = sys.modules.get('sympy')
+        for side in sides:
+            symbols.update(getattr(side, 'free_symbols', ()))
+            if sympy is not None and isinstance(side, sympy.Basic):
+                ops.add(side.func)
+                heads.update(f.func for f in side.atoms(sympy.Function))
+            else:
+                ops.add(type(side))
+        return (lhs_keys, symbols, ops, heads)
+
+    def _indexes(self):
+        return (self._by_lhs, self._by_symbol, self._by_op, self._by_head)
+
+    def insert(self, eq):
+        """Add `eq` to the index and return its ID."""
+        eq_id = self._next_id
+        self._next_id += 1
+        keys = self._index_keys(eq)
+        for (index, index_keys) in zip(self._indexes(), keys):
+            for key in index_keys:
+                index[key].add(eq_id)
+        self._eqs[eq_id] = eq
+        self._keys[eq_id] = keys
+        return eq_id
+
+    def delete(self, eq_id):
+        """Remove the equation with the given `eq_id` from the index."""
+        del self._eqs[eq_id]
+        keys = self._keys.pop(eq_id)
+        for (index, index_keys) in zip(self._indexes(), keys):
+            for key in index_keys:
+                ids = index[key]
+                ids.discard(eq_id)
+                if len(ids) == 0:
+                    del index[key]
+
+    def query(self, lhs=None, symbols=(), ops=(), heads=()):
+        """Sorted list of the IDs of the equations matching all criteria.
+
+        Args:
+            lhs: If not None, the required left-hand-side of the equations
+            symbols: symbols that must all occur in the equation (on either
+                side)
+            ops: top-level operators (e.g. :class:`sympy.Add`) that must all
+                occur as the top-level operator of the lhs or rhs
+            heads: functions (e.g. :class:`sympy.sin`) that must all occur
+                anywhere in the equation
+        """
+        candidates = []
+        if lhs is not None:
+            try:
+                candidates.append(self._by_lhs.get((type(lhs), lhs), set()))
+            except TypeError:  # unhashable lhs are not indexed by `insert`
+                return []
+        for (index, keys) in [
+            (self._by_symbol, symbols),
+            (self._by_op, ops),
+            (self._by_head, heads),
+        ]:
+            for key in keys:
+                candidates.append(index.get(key, set()))
+        if len(candidates) == 0:
+            return sorted(self._eqs)
+        candidates.sort(key=len)
+        return sorted(set.intersection(*candidates))
+
+    def __getitem__(self, eq_id):
+        return self._eqs[eq_id]
+
+    def __contains__(self, eq_id):
+        return eq_id in self._eqs
+
+    def __iter__(self):
+        return iter(self._eqs)
+
+    def __len__(self):
+        return len(self._eqs)
+
+
+MemoryUsage = namedtuple(
+    'MemoryUsage',
+    [
+        'n_equations',
+        'n_lines',
+        'n_unique_expressions',
+        'current_bytes',
+        'history_bytes',
+        'total_bytes',
+    ],
+)
+
+
+def _deep_sizeof(obj, seen):
+    """Size of `obj` and all objects it references, in bytes, excluding
+    objects whose id is in the set `seen` (which is updated)"""
+    sympy = sys.modules.get('sympy')
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, _DiffEntry):
+            stack.extend([obj.expr, obj.diff])
+        elif isinstance(obj, DiffColumn):
+            stack.append(obj._entries)
+        elif isinstance(obj, InternedColumn):
+            stack.append(obj.ids)
+            stack.extend(obj.table[i] for i in set(obj.ids))
+        elif sympy is not None and isinstance(obj, sympy.Basic):
+            stack.extend(obj.args)
+    return size
+
+
+def memory_usage(eqs):
+    """Estimate the memory used by the equations in `eqs`.
+
+    Objects that are shared between equations, or between different lines of
+    the same equation, are counted only once. The size of each object is
+    determined with :func:`sys.getsizeof`, following the arguments of sympy
+    expressions and the items of containers. Other references, e.g., to
+    sympy's global caches, are not followed.
+
+    Returns:
+        MemoryUsage: a named tuple with the following fields:
+
+        * ``n_equations``: the number of equations
+        * ``n_lines``: the total number of lines, including the history
+        * ``n_unique_expressions``: the number of distinct (unequal)
+          expressions on the lhs or rhs of any line
+        * ``current_bytes``: the memory used by the equation objects and
+          their current lhs, rhs, and tag
+        * ``history_bytes``: the memory used by the history (the previous
+          lines), in addition to `current_bytes`
+        * ``total_bytes``: the sum of `current_bytes` and `history_bytes`
+
+    Use this e.g. to decide whether to :meth:`~Eq.reset` long equations, or
+    to store their history more compactly (see :meth:`~Eq.intern_history`,
+    :meth:`~Eq.diff_history`).
+    """
+    eqs = list(eqs)
+    seen = set()
+    current_bytes = 0
+    for eq in eqs:
+        # The equation object and its attribute dict (without following the
+        # references to the history), and the current line
+        for obj in [eq, eq.__dict__]:
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                current_bytes += sys.getsizeof(obj)
+        objs = [eq._lhs, eq._rhs, eq._tag]
+        current_bytes += sum(_deep_sizeof(obj, seen) for obj in objs)
+    history_bytes = 0
+    n_lines = 0
+    exprs = set()
+    for eq in eqs:
+        columns = [eq._prev_lhs, eq._prev_rhs, eq._prev_tags]
+        history_bytes += sum(_deep_sizeof(col, seen) for col in columns)
+        for line in eq._iter_lines():
+            n_lines += 1
+            for expr in line[:2]:
+                if expr is None:
+                    continue
+                try:
+                    exprs.add((type(expr), expr))
+                except TypeError:  # unhashable
+                    exprs.add(('id', id(expr)))
+    return MemoryUsage(
+        n_equations=len(eqs),
+        n_lines=n_lines,
+        n_unique_expressions=len(exprs),
+        current_bytes=current_bytes,
+        history_bytes=history_bytes,
+        total_bytes=current_bytes + history_bytes,
+    )
+
+
+def deduplicate(eqs, key=None):
+    """Remove equivalent equations from `eqs`.
+
+    Args:
+        eqs: iterable of :class:`Eq` instances
+        key (callable or None): function that maps an equation to a hashable
+            key. Equations with the same key are considered equivalent.
+            Defaults to :meth:`Eq.canonical_key`.
+
+    Returns:
+        list: the first equation of each group of equivalent equations, in
+        the order of their first occurrence in `eqs`
+
+    Since equations are grouped by hashing their key, this requires one call
+    to `key` per equation, and no pairwise comparisons.
+
+    Example:
+
+        >>> from sympy import symbols
+        >>> x, y = symbols('x y')
+        >>> eqs = [Eq(x, y), Eq(2 * y, 2 * x), Eq(x, 2 * y), Eq(x - y, 0)]
+        >>> deduplicate(eqs) == [Eq(x, y), Eq(x, 2 * y)]
+        True
+    """
+    if key is None:
+        key = Eq.canonical_key
+    unique = {}
+    for eq in eqs:
+        unique.setdefault(key(eq), eq)
+    return list(unique.values())
+
+
+def _write_lines(lines, file):
+    """Write `lines` to `file`, or return them as a single string if `file`
+    is None"""
+    if file is None:
+        return "\n".join(lines)
+    for line in lines:
+        file.write(line + "\n")
+    return None
+
+
+def render_str(eqs, file=None, renderer=None):
+    """Render the equations in `eqs` as a single aligned block of text.
+
+    Unlike printing each equation separately, the lines of all equations are
+    aligned with each other. The width of all rendered lhs, rhs, and tags is
+    determined in a single pass.
+
+    Args:
+        eqs: iterable of :class:`Eq` instances
+        file: If not None, an open file (or other object with a ``write``
+            method) to which the lines are written one by one
+        renderer: renderer for the lhs, rhs, and tags. Defaults to
+            :data:`str_renderers`.
+
+    Returns:
+        str or None: the rendered text, if `file` is None
+
+    Example:
+
+        >>> from sympy import symbols
+        >>> x, y = symbols('x y')
+        >>> eqs = [Eq(x, 1, tag='a'), Eq(2 * x - y, 5).apply(lambda v: v + y)]
+        >>> print(render_str(eqs))
+              x = 1        (a)
+        2*x - y = 5
+            2*x = y + 5
+    """
+    if renderer is None:
+        renderer = str_renderers
+    eq_syms = []
+    cells = []
+    for eq in eqs:
+        for line_cells in eq._render_cells(renderer):
+            eq_syms.append(eq.eq_sym_str)
+            cells.append(line_cells)
+    n = len(cells)
+    if n == 0:
+        return _write_lines([], file)
+    rendered = [cell for line_cells in cells for cell in line_cells]
+    lens = _grapheme_lens(rendered)
+    len_lhs = max(lens[0::3])
+    len_rhs = max(lens[1::3])
+    lens_sym = {sym: _grapheme_len(sym) for sym in set(eq_syms)}
+    len_sym = max(lens_sym.values())
+
+    def lines():
+        for i in range(n):
+            (lhs, rhs, tag) = cells[i]
+            sym = eq_syms[i]
+            lhs = _rjust(lhs, len_lhs, len_text=lens[3 * i])
+            line = lhs + " " + sym + " " + rhs
+            if len(tag) > 0:
+                # pad to the same tag column for all equations, even if they
+                # use different `eq_sym_str`
+                line = _ljust(
+                    line,
+                    len_lhs + len_rhs + len_sym + 2,
+                    len_text=len_lhs + lens_sym[sym] + lens[3 * i + 1] + 2,
+                )
+                line += "    (" + tag + ")"
+            yield line.rstrip()
+
+    return _write_lines(lines(), file)
+
+
+def render_latex(eqs, file=None):
+    """Render the equations in `eqs` as a single LaTeX ``align`` environment.
+
+    Args:
+        eqs: iterable of :class:`Eq` instances
+        file: If not None, an open file (or other object with a ``write``
+            method) to which the lines are written one by one
+
+    Returns:
+        str or None: the rendered LaTeX code, if `file` is None
+    """
+
+    def rows():
+        for eq in eqs:
+            for (lhs, rhs, tag) in eq._iter_lines():
+                if lhs is None:
+                    row = "   &%s %s" % (
+                        eq.eq_sym_tex,
+                        eq._latex_render_expr(rhs),
+                    )
+                else:
+                    row = "  %s &%s %s" % (
+                        eq._latex_render_expr(lhs),
+                        eq.eq_sym_tex,
+                        eq._latex_render_expr(rhs),
+                    )
+                if tag is not None:
+                    row += r'\tag{%s}' % tag
+                yield row
+
+    def lines():
+        yield r'\begin{align}'
+        prev_row = None
+        for row in rows():
+            if prev_row is not None:
+                yield prev_row + "\\\\"
+            prev_row = row
+        if prev_row is not None:
+            yield prev_row
+        yield r'\end{align}'
+
+    return _write_lines(lines(), file)
+
+
+def _render_chunk(render, eqs):
+    return [render(eq) for eq in eqs]
+
+
+def render_all(eqs, render=str, max_workers=None):
+    """Render each equation in `eqs` in a pool of threads.
+
+    Args:
+        eqs: iterable of :class:`Eq` instances
+        render (callable): function that renders a single equation, e.g.
+            :class:`str` or ``Eq._repr_latex_``
+        max_workers (int or None): number of threads. If None, use one
+            thread per CPU on a free-threaded Python build, and render
+            serially if the GIL is enabled (where threads would only add
+            overhead)
+
+    Returns:
+        list: the rendered equations, in the same order as `eqs`
+
+    The equations are split into contiguous chunks so that each task
+    amortizes the overhead of the thread pool. Rendering only reads the
+    equations; the renderer registries, backends, and caches (including
+    :attr:`Eq.render_cache`) are safe to use concurrently without the GIL.
+
+    Example:
+
+        >>> from sympy import symbols
+        >>> x, y = symbols('x y')
+        >>> render_all([Eq(x, y), Eq(y, 2 * x, tag=1)], max_workers=2)
+        ['x = y', 'y = 2*x    (1)']
+    """
+    eqs = list(eqs)
+    if max_workers is None:
+        gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+        max_workers = 1 if gil_enabled else (os.cpu_count() or 1)
+    if max_workers <= 1 or len(eqs) <= 1:
+        return _render_chunk(render, eqs)
+    n_chunks = min(len(eqs), 4 * max_workers)
+    size = -(-len(eqs) // n_chunks)  # ceil division
+    chunks = [eqs[i : i + size] for i in range(0, len(eqs), size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        results = executor.map(
+            functools.partial(_render_chunk, render), chunks
+        )
+        return [rendered for chunk in results for rendered in chunk]
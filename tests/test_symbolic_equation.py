@@ -1,12 +1,51 @@
 """Tests for `symbolic_equation` package."""
 
+import copy
+import io
+import os
+import pickle
+import threading
+import time
+
 import pytest
 import sympy
 from pkg_resources import parse_version
 from sympy import symbols, sympify
 
 import symbolic_equation
-from symbolic_equation import Eq
+from symbolic_equation import (
+    Backend,
+    DiffColumn,
+    Eq,
+    EqIndex,
+    ExpressionTable,
+    InternedColumn,
+    LRUCache,
+    Operation,
+    RendererRegistry,
+    deduplicate,
+    dumps_equations,
+    get_backend,
+    latex_renderers,
+    linear_system,
+    loads_equations,
+    memory_usage,
+    register_backend,
+    render_all,
+    render_latex,
+    render_str,
+    repr_renderers,
+    str_renderers,
+    time_limit,
+    unregister_backend,
+    write_latex_report,
+)
+from symbolic_equation import (
+    _grapheme_len,
+    _grapheme_lens,
+    _history_digest,
+    _stable_name,
+)
 
 
 def test_valid_version():
@@ -222,3 +261,933 @@ def test_custom_eq_sym():
     assert str(Eq(x, y)) == "x = y"
     tex = Eq(x, y)._repr_latex_()
     assert tex == '\\begin{equation}\n  x = y\n\\end{equation}\n'
+
+
+def _sleep_and_expand(expr, seconds):
+    """Simulate an expensive transformation"""
+    time.sleep(seconds)
+    return sympy.expand(expr)
+
+
+def _integrate_slowly(expr, var):
+    """Integrate `expr`, taking a long time for anything containing `L`"""
+    if expr.has(sympy.Symbol('L')):
+        time.sleep(10)
+    return sympy.integrate(expr, var)
+
+
+def _divide_by_zero(expr):
+    return 1 / 0
+
+
+def _raise_unpicklable(expr):
+    raise ValueError(lambda: expr)
+
+
+def _exit_worker(expr):
+    os._exit(1)
+
+
+def test_time_limit():
+    """Test guarding expensive steps with a time limit."""
+    x = symbols('x')
+    eq = Eq((x + 1) ** 2, x)
+    expanded = eq.apply_to_lhs(time_limit(_sleep_and_expand, 10), 0)
+    assert expanded.lhs == x ** 2 + 2 * x + 1
+    with pytest.raises(TimeoutError):
+        eq.apply(time_limit(_sleep_and_expand, 0.1), 10)
+    kept = eq.apply(time_limit(_sleep_and_expand, 0.1, on_timeout='keep'), 10)
+    assert kept.lhs == eq.lhs
+    assert kept.rhs == eq.rhs
+    timed_out = sympy.Symbol('timed_out')
+    placeholder = eq.apply_to_rhs(
+        time_limit(_sleep_and_expand, 0.1, lambda expr: timed_out), 10
+    )
+    assert placeholder.rhs == timed_out
+    with pytest.raises(ZeroDivisionError):
+        eq.apply(time_limit(_divide_by_zero, 10))
+    with pytest.raises(RuntimeError) as exc_info:
+        eq.apply(time_limit(_raise_unpicklable, 10))
+    assert 'ValueError' in str(exc_info.value)
+    with pytest.raises(RuntimeError) as exc_info:
+        eq.apply(time_limit(_exit_worker, 10))
+    assert 'died without a result' in str(exc_info.value)
+    with pytest.raises(ValueError):
+        time_limit(sympy.expand, 1, on_timeout='ignore')
+    # the time limit and the policy apply to both sides together
+    L = sympy.Symbol('L')
+    eq = Eq(L * x, 2 * x)
+    t0 = time.monotonic()
+    kept = eq.apply(time_limit(_integrate_slowly, 0.5, 'keep'), x)
+    assert time.monotonic() - t0 < 5
+    assert (kept.lhs, kept.rhs) == (L * x, 2 * x)
+    placeholder = eq.apply(
+        time_limit(_integrate_slowly, 0.5, lambda expr: timed_out), x
+    )
+    assert (placeholder.lhs, placeholder.rhs) == (timed_out, timed_out)
+    limited = time_limit(_integrate_slowly, 10, 'keep')
+    integrated = Eq(3 * x, 2 * x).apply(limited, x)
+    assert integrated.rhs == x ** 2
+    assert Eq(3 * x, 2 * x).apply(limited, x, cse=True) == integrated
+    assert eq.apply_to_rhs(limited, x).rhs == x ** 2
+
+
+def test_sum_linear_combination(eq1_eq2):
+    """Test n-ary sum and linear combination of equations"""
+    eq1, eq2 = eq1_eq2
+    assert Eq.sum([eq1, eq2]) == eq1 + eq2
+    assert Eq.sum([eq1, eq2, eq1]) == sum([eq1, eq2, eq1])
+    assert Eq.linear_combination([1, -2], [eq1, eq2]) == eq1 - 2 * eq2
+    assert Eq.sum([Eq(1, 2), Eq(3, 4)]) == Eq(4, 6)
+    with pytest.raises(ValueError):
+        Eq.sum([])
+    with pytest.raises(ValueError):
+        Eq.linear_combination([1], [eq1, eq2])
+    x, y = symbols('x y')
+    eq = Eq(x, y, eq_sym_str='->').apply(lambda v: v + 1).tag(1)
+    for result in [0 + eq, eq + 2, 2 + eq, eq - 2, 2 - eq, 2 * eq, eq / 2]:
+        assert type(result) is Eq
+        assert result.eq_sym_str == '->'
+        assert len(result._prev_rhs) == 0 and result._tag is None
+    assert str(0 + eq) == 'x + 1 -> y + 1'
+    assert str(1 + eq) == 'x + 2 -> y + 2'
+    assert (eq + Eq(y, x)).eq_sym_str == '='
+    assert sum([eq, eq, Eq(1, 1)]) == Eq(2 * x + 3, 2 * y + 3)
+
+    class UnitEq(Eq):
+        def __init__(self, *args, unit='m', **kwargs):
+            super().__init__(*args, **kwargs)
+            self.unit = unit
+
+    eq = UnitEq(x, y, eq_sym_str='->')
+    for result in [eq + eq, eq - 1, 1 - eq, 2 * eq, eq * 2, eq / 2, 0 + eq]:
+        assert type(result) is UnitEq
+        assert result.unit == 'm'
+    assert (2 * eq).eq_sym_str == '->'
+    assert (eq + eq).eq_sym_str == '='
+
+
+def test_linear_system():
+    """Test extracting the matrix form of a linear system of equations"""
+    np = pytest.importorskip('numpy')
+    x, y, z = symbols('x y z')
+    eqs = [Eq(2 * x - y, 1), Eq(x + y, 5 - z), Eq(z, x / 2 + sympy.pi)]
+    A, b = linear_system(eqs, [x, y, z])
+    assert A.tolist() == [[2, -1, 0], [1, 1, 1], [-0.5, 0, 1]]
+    assert b.tolist() == [1, 5, float(sympy.pi)]
+    solution = np.linalg.solve(A, b)
+    for eq in eqs:
+        residual = (eq.lhs - eq.rhs).subs(dict(zip([x, y, z], solution)))
+        assert abs(float(residual)) < 1e-12
+    pytest.importorskip('scipy')
+    A_sparse, b_sparse = linear_system(eqs, [x, y, z], sparse=True)
+    assert (A_sparse.toarray() == A).all()
+    assert (b_sparse == b).all()
+    with pytest.raises(ValueError):
+        linear_system([Eq(x * y, 1)], [x, y])
+    with pytest.raises(ValueError):
+        linear_system([Eq(x, sympy.Symbol('a'))], [x])
+    for nonlinear in [x ** 2, x * sympy.sin(x), sympy.sin(x), 1 / x]:
+        with pytest.raises(ValueError):
+            linear_system([Eq(nonlinear + y, 1)], [x, y])
+    a = sympy.Symbol('a')
+    A, b = linear_system(
+        [Eq(a * x - y, 2 * a), Eq(x, y)], [x, y], dtype=object
+    )
+    assert A.tolist() == [[a, -1], [1, -1]]
+    assert b.tolist() == [2 * a, 0]
+    A, b = linear_system([Eq(0, 1), Eq(x + y, 2)], [x, y])
+    assert A.tolist() == [[0, 0], [1, 1]]
+    assert b.tolist() == [1, 2]
+
+
+def test_renderer_registry():
+    """Test registering custom renderers for specific types"""
+    x = symbols('x')
+
+    class Half(float):
+        """Float subclass with a custom LaTeX representation"""
+
+        def _latex(self):
+            return r'\frac{1}{2}'
+
+    eq = Eq(x, Half(0.5))
+    assert eq._repr_latex_() == (
+        '\\begin{equation}\n  x = \\frac{1}{2}\n\\end{equation}\n'
+    )
+    assert str(eq) == 'x = 0.5'
+    str_renderers.register(float, lambda v: '%.3f' % v)
+    latex_renderers.register(float, lambda v: '%.3f' % v)
+    try:
+        assert str(eq) == 'x = 0.500'
+        assert repr(eq) == 'x = 0.5'
+        assert '0.500' in eq._repr_latex_()
+    finally:
+        str_renderers.unregister(float)
+        latex_renderers.unregister(float)
+    assert str(eq) == 'x = 0.5'
+    assert r'\frac{1}{2}' in eq._repr_latex_()
+
+
+def test_lru_cache():
+    """Test eviction, expiry, and statistics of LRUCache"""
+    cache = LRUCache(maxsize=2, stripes=1)
+    assert cache.cached('a', str.upper, 'a') == 'A'
+    assert cache.cached('b', str.upper, 'b') == 'B'
+    assert cache.cached('a', str.upper, 'x') == 'A'  # hit
+    assert cache.cached('c', str.upper, 'c') == 'C'  # evicts 'b'
+    assert cache.cached('b', str.upper, 'y') == 'Y'
+    assert cache.stats() == (1, 4, 2, 2, 2)
+    assert cache.cached(['unhashable'], str.upper, 'z') == 'Z'
+    assert len(cache) == 2
+    cache.clear()
+    assert cache.stats() == (0, 0, 0, 0, 2)
+    cache = LRUCache(maxsize=2, ttl=0)
+    assert cache.cached('a', str.upper, 'a') == 'A'
+    assert cache.cached('a', str.upper, 'x') == 'X'  # expired
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=0)
+
+
+def test_eq_caches(eq1_eq2):
+    """Test caching of rendered expressions and applied functions"""
+    eq1, eq2 = eq1_eq2
+    eq = (eq1 - eq2).apply(lambda v: v + 4).tag('x')
+    expected_str = str(eq)
+    expected_repr = repr(eq)
+    expected_tex = eq._repr_latex_()
+    Eq.render_cache = LRUCache(maxsize=64)
+    Eq.apply_cache = LRUCache(maxsize=64)
+    try:
+        for _ in range(2):
+            assert str(eq) == expected_str
+            assert repr(eq) == expected_repr
+            assert eq._repr_latex_() == expected_tex
+        assert Eq.render_cache.stats().hits > 0
+        for _ in range(2):
+            assert eq1.apply(sympy.expand) == eq1
+            assert eq1.apply('subs', {symbols('x'): 1}).rhs == 1
+        assert Eq.apply_cache.stats().hits == 2
+        # equal arguments of different types are cached separately
+        x, y = symbols('x y')
+        divide = lambda v, c: v / c  # noqa: E731
+        first = lambda v, c: v / c[0]  # noqa: E731
+        scale = lambda v, c=1: v * c  # noqa: E731
+        assert Eq(x, y).apply(divide, 2).rhs == y / 2
+        assert Eq(x, y).apply(divide, 2.0).rhs == 0.5 * y
+        assert Eq(x, y).apply(divide, sympy.Integer(2)).rhs == y / 2
+        assert Eq(x, y).apply(first, (2,)).rhs == y / 2
+        assert Eq(x, y).apply(first, (2.0,)).rhs == 0.5 * y
+        assert Eq(x, y).apply(scale, c=1).rhs == y
+        assert Eq(x, y).apply(scale, c=1.0).rhs == 1.0 * y
+        rhs = Eq(x, y).apply(scale, c=1.0).rhs
+        assert isinstance(rhs, sympy.Mul) and rhs.args[0] == 1.0
+    finally:
+        Eq.render_cache = None
+        Eq.apply_cache = None
+
+
+def test_lru_cache_threads():
+    """Stress-test LRUCache with many concurrent threads"""
+    cache = LRUCache(maxsize=50, stripes=4)
+    n_threads = 8
+    errors = []
+
+    def worker(seed):
+        for i in range(2000):
+            key = (seed * i) % 100
+            if cache.cached(key, lambda k: k * k, key) != key * key:
+                errors.append(key)
+
+    threads = [
+        threading.Thread(target=worker, args=(seed,))
+        for seed in range(1, n_threads + 1)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    stats = cache.stats()
+    assert stats.hits + stats.misses == n_threads * 2000
+    assert stats.currsize <= 52  # ceil(50 / 4) entries per stripe
+    assert stats.currsize == len(cache)
+
+
+def test_intern_history(eq1_eq2):
+    """Test storing the history as arrays of interned expression IDs"""
+    eq1, eq2 = eq1_eq2
+    x = symbols('x')
+    eq = (
+        (eq1 - eq2)
+        .apply_to_rhs(lambda v: v + 1)
+        .tag('x')
+        .apply('subs', {x: 1})
+    )
+    table = ExpressionTable()
+    interned = eq.intern_history(table)
+    assert isinstance(interned._prev_rhs, InternedColumn)
+    assert str(interned) == str(eq)
+    assert interned._repr_latex_() == eq._repr_latex_()
+    assert interned.lhs == eq.lhs
+    assert interned._prev_lhs.ids[1] == ExpressionTable.NONE_ID
+    assert interned._prev_tags.ids[0] == ExpressionTable.NONE_ID
+    assert interned._prev_lhs == eq._prev_lhs
+    derived = interned.apply(lambda v: v - 4).amend().tag(2)
+    assert isinstance(derived._prev_rhs, InternedColumn)
+    assert str(derived) == str(eq.apply(lambda v: v - 4).amend().tag(2))
+    assert derived._prev_rhs == interned._prev_rhs
+    assert derived._prev_rhs.tobytes() == interned._prev_rhs.tobytes()
+    n_exprs = len(table)
+    eq.intern_history(table)
+    assert len(table) == n_exprs  # no new expressions
+    assert str(Eq(x, 1).intern_history(table).apply(lambda v: 2 * v)) == (
+        '  x = 1\n2*x = 2'
+    )
+
+
+def test_fused_amend(eq1_eq2):
+    """Test that `amend=True` is equivalent to chaining `amend()`"""
+    eq1, eq2 = eq1_eq2
+    x, y = symbols('x y')
+    eq = (eq1 - 2 * eq2).tag("I - 2 II").apply(lambda v: v - 9)
+    for (mtd, args) in [
+        ('apply', (lambda v: v / (-3),)),
+        ('apply', ('subs', {x: 2})),
+        ('apply_to_lhs', ('subs', {y: 3})),
+        ('apply_to_rhs', (lambda v: v + 1,)),
+        ('transform', (lambda eq: eq / 2,)),
+    ]:
+        for base in [eq, eq.apply_to_rhs(lambda v: v + 1), eq.reset()]:
+            chained = getattr(base, mtd)(*args).amend()
+            fused = getattr(base, mtd)(*args, amend=True)
+            assert fused == chained
+            assert str(fused) == str(chained)
+            assert fused._repr_latex_() == chained._repr_latex_()
+
+
+def test_amend_continued_lhs():
+    """Test amending a line whose lhs is needed by the following line"""
+    x, y = symbols('x y')
+    eq = Eq(x, y)
+    assert eq.apply_to_rhs(lambda v: v + 1).amend().lhs == x
+    assert str(eq.apply_to_rhs(lambda v: v + 1).amend()) == 'x = y + 1'
+    eq = Eq(x, y).apply_to_rhs(lambda v: 2 * v)
+    amended = eq.apply_to_lhs(lambda v: v + 1).apply('expand').amend(2)
+    assert amended.lhs == x + 1
+    assert str(amended) == '    x = y\nx + 1 = 2*y'
+
+
+def test_compact_history_keeps_settings():
+    """Test that intern_history and diff_history keep instance settings"""
+    x, y = symbols('x y')
+    eq = Eq(x, y, eq_sym_str='->').apply(lambda v: v + 1)
+    eq.record_operations = True
+    eq.display_max_lines = 3
+    for compact in [eq.intern_history(ExpressionTable()), eq.diff_history()]:
+        assert compact.record_operations
+        assert compact.display_max_lines == 3
+        assert compact.eq_sym_str == '->'
+        assert str(compact) == str(eq)
+        assert len(compact.apply(lambda v: 2 * v).operations) == 1
+
+
+def test_diff_history():
+    """Test storing the history as diffs between consecutive steps"""
+    x, y, a = symbols('x y a')
+    big = sum(sympy.sin(k * x) * sympy.exp(y / k) for k in range(1, 8))
+    eq = Eq(y, big + (a + 1) ** 2).diff_history(keyframe_interval=3)
+    plain = eq.reset()
+    for k in range(1, 8):
+        eq = eq.apply_to_rhs('subs', {sympy.sin(k * x): sympy.cos(k * x)})
+        plain = plain.apply_to_rhs(
+            'subs', {sympy.sin(k * x): sympy.cos(k * x)}
+        )
+    eq = eq.apply_to_rhs(sympy.expand).apply(lambda v: v - a ** 2)
+    plain = plain.apply_to_rhs(sympy.expand).apply(lambda v: v - a ** 2)
+    assert isinstance(eq._prev_rhs, DiffColumn)
+    assert eq._prev_rhs == plain._prev_rhs
+    assert eq._prev_lhs == plain._prev_lhs
+    n_full = sum(entry.diff is None for entry in eq._prev_rhs._entries)
+    assert n_full < len(eq._prev_rhs)
+    eq._prev_rhs._cache.clear()
+    assert [eq._prev_rhs[i] for i in range(9)] == list(plain._prev_rhs)
+    assert str(eq) == str(plain)
+    assert str(eq.amend(3)) == str(plain.amend(3))
+    assert eq.amend(3)._prev_rhs[-1] == plain._prev_rhs[-4]
+    assert eq.lhs == plain.lhs
+    assert eq._prev_rhs[2:5] == plain._prev_rhs[2:5]
+    with pytest.raises(IndexError):
+        eq._prev_rhs[20]
+
+
+def test_unaligned_str(eq1_eq2):
+    """Test rendering without alignment"""
+    eq1, _ = eq1_eq2
+    eq = eq1.apply(sympy.simplify).apply(lambda v: v + 1).tag(2)
+    assert str(eq) == (
+        '    2*x - y = 1    (I)\n            = 1\n2*x - y + 1 = 2    (2)'
+    )
+    lines = ['2*x - y = 1    (I)', ' = 1', '2*x - y + 1 = 2    (2)']
+    assert list(eq.str_lines()) == lines
+    eq.align_str = False
+    assert str(eq) == "\n".join(lines)
+    assert repr(eq) == "\n".join(lines).replace('(I)', "('I')")
+    assert list(eq.str_lines(widths=(11, 1))) == [
+        '    2*x - y = 1    (I)',
+        '            = 1',
+        '2*x - y + 1 = 2    (2)',
+    ]
+
+
+def test_grapheme_lens():
+    """Test batch computation of the printed length of strings"""
+    texts = ['abc', 'Â', '', 'a\r\nb', 'x̂ + y', '🇩🇪']
+    expected = [_grapheme_len(text) for text in texts]
+    assert expected == [3, 1, 0, 3, 5, 1]
+    assert _grapheme_lens(texts) == expected
+    assert _grapheme_lens(texts[:1] + texts[3:4]) == [3, 3]
+    x, y = symbols('x y')
+    xhat = sympy.Symbol('x̂')
+    eq = Eq(xhat, y, tag='Â').apply_to_lhs(lambda v: v + x)
+    assert str(eq) == '    x̂ = y    (Â)\nx + x̂ = y'
+
+
+def test_truncated_display():
+    """Test omitting lines in the display of long equations"""
+    x = symbols('x')
+    eq = Eq(x, 0)
+    for i in range(1, 6):
+        eq = eq.apply(lambda v: v + 1).tag(i)
+    full_repr = repr(eq)
+    full_tex = eq._repr_latex_()
+    assert eq.to_latex() == full_tex
+    eq.display_max_lines = 4
+    eq.display_head = 1
+    eq.display_tail = 2
+    assert repr(eq) == (
+        '    x = 0\n      ...\nx + 4 = 4    (4)\nx + 5 = 5    (5)'
+    )
+    assert str(eq) == full_repr
+    tex = eq._repr_latex_()
+    assert tex == (
+        '\\begin{align}\n  x &= 0\\\\\n   &\\vdots\\\\\n'
+        '  x + 4 &= 4\\tag{4}\\\\\n  x + 5 &= 5\n\\tag{5}\\end{align}\n'
+    )
+    assert eq.to_latex() == full_tex
+    eq.display_max_lines = 6
+    assert repr(eq) == full_repr
+    eq.display_max_lines = 4
+    eq.align_str = False
+    assert repr(eq) == 'x = 0\n...\nx + 4 = 4    (4)\nx + 5 = 5    (5)'
+
+
+def test_write_latex_report(eq1_eq2, tmp_path):
+    """Test writing a LaTeX report with content-addressed fragments"""
+    eq1, eq2 = eq1_eq2
+    eq3 = (eq1 + eq2).apply(lambda v: v / 3).tag('x')
+    master = write_latex_report([eq1, eq2, eq3], tmp_path)
+    assert master == tmp_path / 'report.tex'
+    content = master.read_text()
+    assert content.startswith('\\documentclass{article}\n')
+    assert content.count('\\input{fragments/') == 3
+    fragments = sorted((tmp_path / 'fragments').glob('*.tex'))
+    assert len(fragments) == 3
+    tex = {f.read_text() for f in fragments}
+    assert tex == {eq._repr_latex_() for eq in [eq1, eq2, eq3]}
+    mtimes = {f.name: f.stat().st_mtime_ns for f in fragments}
+    master_mtime = master.stat().st_mtime_ns
+    time.sleep(0.01)
+    write_latex_report([eq1, eq2, eq3], tmp_path)
+    assert master.stat().st_mtime_ns == master_mtime
+    eq3_new = eq3.apply(lambda v: 3 * v)
+    write_latex_report([eq1, eq2, eq3_new], tmp_path)
+    fragments = sorted((tmp_path / 'fragments').glob('*.tex'))
+    assert len(fragments) == 3
+    new = [f for f in fragments if f.name not in mtimes]
+    assert len(new) == 1
+    assert new[0].read_text() == eq3_new._repr_latex_()
+    for f in fragments:
+        if f.name in mtimes:
+            assert f.stat().st_mtime_ns == mtimes[f.name]
+
+
+def test_latex_report_digest(tmp_path):
+    """Test that fragments are re-rendered exactly when the LaTeX changes"""
+    np = pytest.importorskip('numpy')
+    x = symbols('x')
+    eq = Eq(x, 0.5)
+    key = _history_digest(eq)
+
+    def make_renderer():
+        def render_half(value):
+            return r'\tfrac{1}{2}'
+
+        return staticmethod(render_half)
+
+    class MyEq(Eq):
+        latex_renderer = make_renderer()
+
+    my_key = _history_digest(MyEq(x, 0.5))
+    assert '0x' not in _stable_name(MyEq.latex_renderer)
+    assert my_key != key
+    MyEq.latex_renderer = make_renderer()  # same name, different object
+    assert _history_digest(MyEq(x, 0.5)) == my_key
+
+    write_latex_report([eq], tmp_path)
+    latex_renderers.register(float, lambda v: r'\tfrac{1}{2}')
+    try:
+        assert _history_digest(eq) != key
+        master = write_latex_report([eq], tmp_path)
+    finally:
+        latex_renderers.unregister(float)
+    fragment = master.read_text().split('\\input{')[1].split('}')[0]
+    assert 'tfrac' in (tmp_path / (fragment + '.tex')).read_text()
+    assert _history_digest(eq) == key
+
+    a = np.zeros(10000)
+    b = a.copy()
+    b[5000] = 1
+    assert repr(a) == repr(b)
+    assert _history_digest(Eq(x, a)) != _history_digest(Eq(x, b))
+
+
+def test_pickle(eq1_eq2):
+    """Test pickling equations with compact history encoding"""
+    eq1, eq2 = eq1_eq2
+    x = symbols('x')
+    eq = (
+        (eq1 - eq2)
+        .apply_to_rhs(lambda v: v + 4)
+        .apply('subs', {x: 1})
+        .tag('last')
+    )
+    eq.eq_sym_str = '->'
+    restored = pickle.loads(pickle.dumps(eq))
+    assert type(restored) is Eq
+    assert restored == eq
+    assert str(restored) == str(eq)
+    assert restored._repr_latex_() == eq._repr_latex_()
+    assert restored.__dict__['eq_sym_str'] == '->'
+    assert restored._prev_lhs == eq._prev_lhs
+    assert restored._prev_tags == eq._prev_tags
+    interned = eq.intern_history(ExpressionTable())
+    assert str(pickle.loads(pickle.dumps(interned))) == str(eq)
+    eqs = [eq1, eq, eq.apply(lambda v: v + 1), pickle.loads(pickle.dumps(eq))]
+    payload = dumps_equations(eqs)
+    assert len(payload) < len(pickle.dumps(eqs))
+    restored = loads_equations(payload)
+    assert [str(eq) for eq in restored] == [str(eq) for eq in eqs]
+    assert restored[2]._prev_rhs[1] is restored[1]._prev_rhs[1]
+    assert restored[3]._prev_rhs[1] is restored[1]._prev_rhs[1]
+
+
+def test_eq_index():
+    """Test searching equations with EqIndex"""
+    x, y, z = symbols('x y z')
+    f = sympy.Function('f')
+    eqs = [
+        Eq(x, y + 1),
+        Eq(y, sympy.sin(z)),
+        Eq(z, f(x) * y),
+        Eq(x, f(y)).apply_to_rhs('subs', {y: z}),
+    ]
+    index = EqIndex(eqs)
+    assert len(index) == 4
+    assert index.query(lhs=x) == [0, 3]
+    assert index.query(lhs=x, symbols=[z]) == [3]
+    assert index.query(symbols=[y]) == [0, 1, 2]
+    assert index.query(heads=[f]) == [2, 3]
+    assert index.query(heads=[f], ops=[sympy.Mul]) == [2]
+    assert index.query(lhs=z, heads=[sympy.sin]) == []
+    assert index.query() == [0, 1, 2, 3]
+    new_id = index.insert(Eq(x, sympy.sin(y)))
+    assert index[new_id].rhs == sympy.sin(y)
+    assert index.query(lhs=x, heads=[sympy.sin]) == [new_id]
+    index.delete(1)
+    assert 1 not in index
+    assert index.query(heads=[sympy.sin]) == [new_id]
+    assert list(index) == [0, 2, 3, new_id]
+    matrix_id = index.insert(Eq(sympy.Matrix([x]), sympy.Matrix([y])))
+    assert index.query(lhs=sympy.Matrix([x])) == []
+    assert matrix_id in index.query(symbols=[y])
+
+
+def test_backends():
+    """Test selecting the zero element and LaTeX renderer via backends"""
+    x = symbols('x')
+    assert Eq(x).rhs is sympy.S.Zero
+    assert Eq(1.5).rhs == 0
+    assert type(Eq(1.5).rhs) is int
+    assert Eq(1.5, 2)._repr_latex_() == (
+        '\\begin{equation}\n  1.5 = 2\n\\end{equation}\n'
+    )
+
+    class Vector(tuple):
+        """Minimal custom expression type"""
+
+    class VectorBackend(Backend):
+        """Backend for Vector"""
+
+        def handles(self, type_):
+            return issubclass(type_, Vector)
+
+        def zero(self, expr):
+            return Vector([0] * len(expr))
+
+        def latex(self, expr):
+            return r'\vec{(%s)}' % ", ".join(str(v) for v in expr)
+
+        def to_sympy(self, expr):
+            return sympy.Matrix(expr)
+
+    assert Eq(Vector([1, 2])).rhs == 0
+    backend = VectorBackend()
+    register_backend(backend)
+    try:
+        eq = Eq(Vector([1, 2]))
+        assert eq.rhs == Vector([0, 0])
+        assert r'\vec{(1, 2)} = \vec{(0, 0)}' in eq._repr_latex_()
+        assert sympy.sympify(eq) == sympy.Eq(
+            sympy.Matrix([1, 2]), sympy.Matrix([0, 0])
+        )
+        assert get_backend(Vector).__class__ is VectorBackend
+    finally:
+        unregister_backend(backend)
+    assert type(get_backend(Vector)) is Backend
+    with pytest.raises(ValueError):
+        unregister_backend(backend)
+
+
+def test_memory_usage(eq1_eq2):
+    """Test estimating the memory used by equations"""
+    eq1, eq2 = eq1_eq2
+    x = symbols('x')
+    eq = (eq1 - eq2).apply(lambda v: v + 4).apply('subs', {x: 1})
+    usage = eq.memory_usage()
+    assert usage.n_equations == 1
+    assert usage.n_lines == 3
+    assert usage.n_unique_expressions == 5
+    assert usage.current_bytes > 0
+    assert usage.history_bytes > 0
+    assert usage.total_bytes == usage.current_bytes + usage.history_bytes
+    assert eq.reset().memory_usage().history_bytes < usage.history_bytes
+    corpus = memory_usage([eq, eq.copy()])
+    assert corpus.n_equations == 2
+    assert corpus.n_lines == 6
+    assert corpus.n_unique_expressions == 5
+    assert corpus.history_bytes == usage.history_bytes  # shared history
+    assert corpus.total_bytes < 2 * usage.total_bytes
+    interned = memory_usage([eq.intern_history(ExpressionTable())])
+    assert interned.n_unique_expressions == 5
+    diffed = memory_usage([eq.diff_history()])
+    assert diffed.n_lines == 3
+
+
+def test_apply_pipeline(eq1_eq2):
+    """Test applying several steps at once"""
+    eq1, _ = eq1_eq2
+    x, y = symbols('x y')
+    steps = [
+        lambda v: v + y,
+        ('subs', [{x: 2}]),
+        (lambda v, c, d=0: c * v + d, (2,), {'d': 1}),
+    ]
+    chained = (
+        eq1.apply(lambda v: v + y)
+        .apply('subs', {x: 2})
+        .apply(lambda v, c, d=0: c * v + d, 2, d=1)
+    )
+    eq = eq1.apply_pipeline(steps)
+    assert eq == chained
+    assert str(eq) == str(chained.amend(2))
+    assert str(eq1.apply_pipeline(steps, record_all=True)) == str(chained)
+    assert str(eq1.apply_pipeline(steps, amend=True)) == str(chained.amend(3))
+    expected = (
+        eq1.apply(lambda v: v + y, amend=True)
+        .apply('subs', {x: 2})
+        .apply(lambda v, c, d=0: c * v + d, 2, d=1)
+    )
+    eq = eq1.apply_pipeline(steps, record_all=True, amend=True)
+    assert str(eq) == str(expected)
+    unchanged = eq1.apply_pipeline(['expand', sympy.simplify])
+    assert str(unchanged) == '2*x - y = 1    (I)\n        = 1'
+    with pytest.raises(ValueError):
+        eq1.apply_pipeline([('expand', (), {}, None)])
+
+
+def test_render_collection(eq1_eq2):
+    """Test rendering many equations as a single aligned block"""
+    eq1, eq2 = eq1_eq2
+    eq3 = (eq1 + eq2).apply(lambda v: v / 3).tag('x')
+    assert render_str([eq1, eq2, eq3]) == (
+        '2*x - y = 1    (I)\n'
+        '  x + y = 5    (II)\n'
+        '    3*x = 6\n'
+        '      x = 2    (x)'
+    )
+    assert render_str([eq1]) == str(eq1)
+    assert render_str([]) == ''
+    x = symbols('x')
+    eqs = [Eq(x, 1, tag=1, eq_sym_str='->'), Eq(x, 22, tag=2)]
+    assert render_str(eqs) == 'x -> 1     (1)\nx = 22     (2)'
+    eqs = [Eq(x, 1, tag=1, eq_sym_str='\u2192'), Eq(x, 22, tag=2)]
+    assert render_str(eqs) == 'x \u2192 1     (1)\nx = 22    (2)'
+    assert render_str([eq1], renderer=repr_renderers) == repr(eq1)
+    tex = render_latex([eq1, eq3])
+    assert tex == (
+        '\\begin{align}\n'
+        '  2 x - y &= 1\\tag{I}\\\\\n'
+        '  3 x &= 6\\\\\n'
+        '  x &= 2\\tag{x}\n'
+        '\\end{align}'
+    )
+    fh = io.StringIO()
+    assert render_latex([eq1, eq3], file=fh) is None
+    assert fh.getvalue() == tex + "\n"
+    fh = io.StringIO()
+    render_str([eq1, eq2, eq3], file=fh)
+    assert fh.getvalue() == render_str([eq1, eq2, eq3]) + "\n"
+
+
+def test_apply_cse():
+    """Test applying a function to common subexpressions only once"""
+    x, y, a, b = symbols('x y a b')
+    shared = sympy.sin(x) ** 2 + sympy.cos(x) ** 2
+    eq = Eq(shared * a + sympy.exp(shared), shared * b)
+    calls = []
+
+    def simplify(expr):
+        calls.append(expr)
+        return sympy.simplify(expr)
+
+    result = eq.apply(simplify, cse=True)
+    assert result.lhs == a + sympy.E
+    assert result.rhs == b
+    assert result == eq.apply(sympy.simplify)
+    # the shared subexpression was transformed only once, on its own
+    assert [expr for expr in calls if expr.has(sympy.sin(x))] == [shared]
+    result = Eq(x, y).apply(simplify, cse=True)  # nothing in common
+    assert str(result) == 'x = y\n  = y'
+    assert Eq(1, 2).apply(lambda v: v + 1, cse=True) == Eq(2, 3)
+    assert eq.apply('subs', {a: 1}, cse=True) == eq.apply('subs', {a: 1})
+    # functions that do not commute with substitution: the subexpressions
+    # depending on the symbol in the arguments must not be extracted
+    eq = Eq(sympy.sin(x + 1) * x, sympy.sin(x + 1) * y)
+    for func in [sympy.diff, 'diff']:
+        result = eq.apply(func, x, cse=True)
+        assert result.rhs == y * sympy.cos(x + 1)
+        assert result == eq.apply(func, x)
+    assert eq.apply('subs', {x: 2}, cse=True) == eq.apply('subs', {x: 2})
+
+
+def test_record_replay():
+    """Test recording operations and replaying them on a changed equation"""
+    x, y, a = sympy.symbols('x y a')
+    calls = []
+
+    def expand(expr):
+        calls.append(expr)
+        return sympy.expand(expr)
+
+    eq = Eq(y, (x + 1) ** 2)
+    assert eq.operations == ()
+    assert eq.apply_to_rhs(expand).operations == ()
+    eq.record_operations = True
+    result = eq.apply_to_rhs(expand).tag(1).apply('subs', {x: 2}).amend()
+    assert [op.method for op in result.operations] == [
+        'apply_to_rhs',
+        'tag',
+        'apply',
+        'amend',
+    ]
+    assert isinstance(result.operations[0], Operation)
+    assert result.operations[0].args == (expand,)
+    assert result.operations[0].inputs == (y, (x + 1) ** 2)
+
+    calls.clear()
+    replayed = result.replay(Eq(y, (x + 1) ** 2))
+    assert replayed == result
+    assert str(replayed) == str(result)
+    assert calls == []  # nothing changed: no step was re-computed
+    assert replayed.operations == result.operations
+
+    replayed = result.replay(Eq(y, (x + a) ** 2))
+    assert calls == [(x + a) ** 2]
+    assert replayed.rhs == a ** 2 + 4 * a + 4
+    assert str(replayed) == 'y = (a + x)**2\n  = a**2 + 4*a + 4'
+    assert len(replayed.operations) == 4
+
+    # recorded operations survive pickling (with picklable functions)
+    eq = Eq(y, (x + 1) ** 2)
+    eq.record_operations = True
+    result = eq.apply_to_rhs(sympy.expand).apply('subs', {x: 2}).tag(1)
+    restored = [pickle.loads(pickle.dumps(result)), copy.deepcopy(result)]
+    for restored_eq in restored:
+        assert restored_eq.operations == result.operations
+        new = restored_eq.replay(Eq(y, (x + a) ** 2))
+        assert new.rhs == a ** 2 + 4 * a + 4
+    (restored_eq,) = loads_equations(dumps_equations([result]))
+    assert restored_eq.operations == result.operations
+    assert restored_eq.replay(Eq(y, (x + a) ** 2)).rhs == a ** 2 + 4 * a + 4
+    plain = pickle.loads(pickle.dumps(Eq(y, x).apply(sympy.expand)))
+    assert plain.operations == ()
+
+
+def test_render_all():
+    """Test rendering equations in parallel threads"""
+    x, y = sympy.symbols('x y')
+    eqs = [Eq(x + i, y).apply(lambda v: v * i).tag(i) for i in range(50)]
+    expected = [str(eq) for eq in eqs]
+    assert render_all(eqs) == expected
+    assert render_all(eqs, max_workers=4) == expected
+    assert render_all(eqs, max_workers=64) == expected
+    assert render_all(iter(eqs[:1]), max_workers=4) == expected[:1]
+    assert render_all([], max_workers=4) == []
+    latex = render_all(eqs, render=Eq._repr_latex_, max_workers=3)
+    assert latex == [eq._repr_latex_() for eq in eqs]
+
+    # concurrent registration and dispatch never leaves stale renderers
+    registry = RendererRegistry(default=lambda type_: str)
+    types = [type('T%d' % i, (int,), {}) for i in range(8)]
+
+    def worker(type_):
+        for i in range(100):
+            registry.register(type_, lambda v, i=i: '%s:%d' % (v, i))
+            registry(type_(1))
+            registry(True)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in types]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [registry(type_(1)) for type_ in types] == ['1:99'] * len(types)
+
+
+def test_verify_history():
+    """Test the numerical verification of the steps of an equation"""
+    x, y, z = sympy.symbols('x y z')
+    eq = (
+        Eq((x + 1) ** 2, y * sympy.exp(z))
+        .apply_to_lhs(sympy.expand)
+        .apply(lambda v: v - y * sympy.exp(z))
+        .apply(lambda v: 3 * v)
+        .apply_to_rhs(lambda v: v + sympy.sin(x) ** 2 + sympy.cos(x) ** 2 - 1)
+        .apply_to_rhs(lambda v: v + x)  # wrong
+        .apply_to_rhs(lambda v: v - x)  # wrong (undoes the previous error)
+    )
+    assert eq.verify_history(seed=1) == [5, 6]
+    assert Eq(x, y).verify_history() == []
+    # identities stay identities
+    identity = Eq((x + 1) ** 2, x ** 2 + 2 * x + 1).apply_to_lhs(sympy.expand)
+    assert identity.verify_history(seed=1) == []
+    assert identity.apply(lambda v: v + 1).verify_history(seed=1) == []
+    assert Eq(x, y).apply(lambda v: 0 * v).verify_history(seed=1) == [1]
+    # non-finite sample points are ignored
+    eq = Eq(sympy.log(x - 1), y).apply(sympy.exp)
+    assert eq.verify_history(domain=(0.1, 0.9)) == []
+    assert eq.verify_history(seed=1, domain=(1.5, 3)) == [1]
+    # multiplying with an expression is a known false positive
+    assert Eq(x, y).apply(lambda v: x * v).verify_history(seed=1) == [1]
+    # plain numbers
+    assert Eq(1, 1).apply(lambda v: v + 1).verify_history() == []
+    # undefined functions are replaced by random concrete functions
+    f, g = sympy.Function('f'), sympy.Function('g')
+    eq = Eq(f(x), g(x, y)).apply(lambda v: 2 * v)
+    assert eq.verify_history(seed=1) == []
+    assert eq.apply_to_lhs(lambda v: v + 1).verify_history(seed=1) == [2]
+    eq = Eq(f(x).diff(x), y).apply(lambda v: v - y).apply_to_lhs(sympy.expand)
+    assert eq.verify_history(seed=1) == []
+    assert eq.apply_to_lhs(lambda v: v + x).verify_history(seed=1) == [3]
+    # residuals without a numerical equivalent are unverifiable
+    integral = sympy.Integral(sympy.sin(x * y), (y, 0, 1))
+    eq = Eq(integral, z).apply(lambda v: 2 * v).apply_to_rhs(lambda v: v + 1)
+    assert eq.verify_history() == []
+    eq = Eq(integral, z).apply_to_lhs(lambda v: x).apply_to_rhs(sympy.sin)
+    assert eq.verify_history(seed=1) == [2]
+
+
+def test_derived_eq_shares_history():
+    """Test that copies and retagged equations share the history"""
+
+    class MyEq(Eq):
+        pass
+
+    x, y = sympy.symbols('x y')
+    eq = MyEq(x, y, eq_sym_str='==').apply(lambda v: v + 1).tag('2')
+    assert type(eq) is MyEq
+    assert eq._tag == 2
+    assert eq.eq_sym_str == '=='
+    assert 'eq_sym_tex' not in eq.__dict__
+    for derived in [eq.copy(), eq.tag(3), eq.tag('b').copy()]:
+        assert type(derived) is MyEq
+        assert derived.eq_sym_str == '=='
+        assert derived._prev_lhs is eq._prev_lhs
+        assert derived._prev_rhs is eq._prev_rhs
+        assert derived._prev_tags is eq._prev_tags
+    assert eq.tag('b')._tag == 'b'
+    assert str(eq.copy()) == str(eq) == '    x == y\nx + 1 == y + 1    (2)'
+    reset = eq.reset()
+    assert type(reset) is MyEq
+    assert str(reset) == 'x + 1 == y + 1    (2)'
+    assert eq.apply(lambda v: 2 * v).eq_sym_str == '=='
+    assert eq.amend().eq_sym_str == '=='
+
+
+def test_deduplicate():
+    """Test canonical keys and deduplication of equivalent equations"""
+    x, y, z = sympy.symbols('x y z')
+    key = Eq((x + 1) ** 2, y).canonical_key()
+    assert key == x ** 2 + 2 * x - y + 1
+    equivalent = [
+        Eq(y, (x + 1) ** 2),
+        Eq(-3 * y, -3 * (x + 1) ** 2),
+        Eq((x + 1) ** 2 / 2, y / 2),
+        Eq(x ** 2 + 2 * x + 1 - y, 0),
+        Eq(z, x)
+        .apply_to_lhs(lambda v: y)
+        .apply_to_rhs(lambda v: (v + 1) ** 2),
+    ]
+    assert [eq.canonical_key() for eq in equivalent] == [key] * 5
+    assert Eq(x, x).canonical_key() == 0
+    assert Eq(2, 4).canonical_key() == 1
+    assert Eq(x, 2 * y).canonical_key() != Eq(x, y).canonical_key()
+
+    eqs = [Eq(x, 1), *equivalent, Eq(2 * x, 2), Eq(x, x), Eq(y, y)]
+    unique = deduplicate(eqs)
+    assert [str(eq) for eq in unique] == [
+        'x = 1',
+        'y = (x + 1)**2',
+        'x = x',
+    ]
+    assert unique[1] is equivalent[0]
+    assert deduplicate([]) == []
+    unique = deduplicate(eqs, key=lambda eq: eq.lhs)
+    assert unique == [eqs[i] for i in [0, 1, 2, 3, 4, 6]]
+
+
+def test_cached_conversions():
+    """Test that as_dict and _sympy_ are cached and shared with copies"""
+    x, y, z = sympy.symbols('x y z')
+    eq = Eq(x, y + 1).apply_to_rhs(lambda v: v + z)
+    mapping = eq.as_dict
+    assert mapping == {x: y + z + 1}
+    assert eq.as_dict is mapping
+    with pytest.raises(TypeError):
+        mapping[z] = 5
+    assert eq.copy().as_dict == {x: y + z + 1}
+    assert (x * z).subs(mapping) == (y + z + 1) * z
+    assert dict(mapping) == {x: y + z + 1}
+    sympy_eq = sympy.sympify(eq)
+    assert sympy_eq == sympy.Eq(x, y + z + 1)
+    assert eq._sympy_() is sympy_eq
+    for derived in [eq.copy(), eq.tag(1), eq.reset(), eq.amend()]:
+        assert derived.as_dict is mapping
+        assert derived._sympy_() is sympy_eq
+    new = eq.apply_to_rhs(lambda v: v - z)
+    assert new.as_dict == {x: y + 1}
+    assert new._sympy_() == sympy.Eq(x, y + 1)
+    assert (x ** 2).subs(new.as_dict) == (y + 1) ** 2
+    assert eq.as_dict == {x: y + z + 1}  # unchanged
+    assert pickle.loads(pickle.dumps(eq)).as_dict == mapping